@@ -0,0 +1,110 @@
+"""Caches shared by the workflow helpers, auth functions and queries."""
+from __future__ import annotations
+
+import functools
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, TypeVar
+
+from flask import has_request_context
+
+import ckan.plugins.toolkit as tk
+
+
+def request_cache(name: str) -> Optional[dict[Any, Any]]:
+    """Return a dict named ``name`` that lives as long as the current request.
+
+    Outside of a request (CLI commands, background jobs) there is nothing to
+    scope the cache to, so ``None`` is returned and callers should not cache.
+    """
+    if not has_request_context():
+        return None
+
+    caches = getattr(tk.g, "_workflow_caches", None)
+    if caches is None:
+        caches = tk.g._workflow_caches = {}
+    return caches.setdefault(name, {})
+
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+def memoize_per_request(func: F) -> F:
+    """Cache the results of ``func`` for the current request, by its
+    arguments, which must be hashable. Outside of a request ``func`` is always
+    called."""
+    name = f"{func.__module__}.{func.__qualname__}"
+
+    @functools.wraps(func)
+    def wrapper(*args: Hashable, **kwargs: Hashable) -> Any:
+        cache = request_cache(name)
+        if cache is None:
+            return func(*args, **kwargs)
+        key = (args, tuple(sorted(kwargs.items())))
+        try:
+            return cache[key]
+        except KeyError:
+            result = cache[key] = func(*args, **kwargs)
+            return result
+
+    return wrapper  # type: ignore
+
+
+def clear_request_cache(name: str):
+    """Drop the request cache called ``name``, if there is one."""
+    if has_request_context():
+        getattr(tk.g, "_workflow_caches", {}).pop(name, None)
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after ``ttl`` seconds.
+
+    The size and lifetime are read from the CKAN config options
+    ``size_option`` and ``ttl_option`` the first time the cache is used.
+    """
+
+    def __init__(
+        self, size_option: str, ttl_option: str, size: int = 1000, ttl: int = 300
+    ):
+        self.size_option = size_option
+        self.ttl_option = ttl_option
+        self._default_size = size
+        self._default_ttl = ttl
+        self._size: Optional[int] = None
+        self._ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _configure(self):
+        self._size = tk.asint(tk.config.get(self.size_option, self._default_size))
+        self._ttl = tk.asint(tk.config.get(self.ttl_option, self._default_ttl))
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            if self._size is None:
+                self._configure()
+            if self._size <= 0 or self._ttl <= 0:
+                return
+            self._data[key] = (time.monotonic() + self._ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self._size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            # Pick up config changes, mostly useful in tests
+            self._size = None
@@ -0,0 +1,29 @@
+import click
+
+from ckanext.workflow import notifications
+
+
+@click.group(short_help="Workflow commands")
+def workflow():
+    pass
+
+
+@workflow.command("send-digests")
+@click.option(
+    "--force", is_flag=True, help="Send everything queued, ignoring the digest interval"
+)
+@click.pass_context
+def send_digests(ctx, force):
+    """Send the workflow notification digests that are due.
+
+    Run this regularly (e.g. from cron) when
+    ckan.workflow.notification_digest_interval is set.
+    """
+    flask_app = ctx.meta["flask_app"]
+    with flask_app.test_request_context():
+        sent = notifications.send_digests(force)
+    click.secho(f"Sent {sent} workflow digest emails", fg="green")
+
+
+def get_commands():
+    return [workflow]
@@ -0,0 +1,69 @@
+"""Handling of datasets created and updated by harvesters.
+
+The ``IPackageController`` hooks need to tell datasets saved from the dataset
+form apart from harvested ones. Harvest jobs can say so up front, either by
+running inside ``harvest_mode()`` or by passing ``"workflow_harvest": True``
+in the action context, and the hooks then skip looking at the request::
+
+    with harvest_mode():
+        for data_dict in harvested:
+            tk.get_action("package_create")(context.copy(), data_dict)
+"""
+from __future__ import annotations
+
+import contextlib
+from contextvars import ContextVar
+from typing import Any, Iterator
+
+from flask import has_request_context
+
+import ckan.plugins.toolkit as tk
+
+# Action context key that marks a package_create/package_update as harvested
+CONTEXT_KEY = "workflow_harvest"
+
+# Blueprints of the dataset form, saves from anywhere else count as harvested
+DATASET_BLUEPRINTS = frozenset(["package", "dataset", "datavic_dataset"])
+
+# (workflow_status, organization_visibility) given to harvested datasets that
+# have none, by their `private` value
+DEFAULTS = {
+    True: ("draft", "current"),
+    False: ("published", "all"),
+}
+
+_harvest_mode: ContextVar[bool] = ContextVar("workflow_harvest_mode", default=False)
+
+
+@contextlib.contextmanager
+def harvest_mode(enabled: bool = True) -> Iterator[None]:
+    """Treat every dataset saved inside the block as harvested."""
+    token = _harvest_mode.set(enabled)
+    try:
+        yield
+    finally:
+        _harvest_mode.reset(token)
+
+
+def is_harvest_mode() -> bool:
+    return _harvest_mode.get()
+
+
+def is_dataset_form_save() -> bool:
+    """Whether the dataset being saved comes from the dataset form."""
+    if _harvest_mode.get() or not has_request_context():
+        return False
+    return tk.get_endpoint()[0] in DATASET_BLUEPRINTS
+
+
+def apply_defaults(extras: dict[str, Any], private: Any):
+    """Fill in the workflow_status and organization_visibility a harvested
+    dataset is missing, in place."""
+    if extras.get("workflow_status") and extras.get("organization_visibility"):
+        return
+
+    workflow_status, organization_visibility = DEFAULTS[tk.asbool(private)]
+    if not extras.get("workflow_status"):
+        extras["workflow_status"] = workflow_status
+    if not extras.get("organization_visibility"):
+        extras["organization_visibility"] = organization_visibility
@@ -0,0 +1,328 @@
+"""In-memory ancestor/descendant index of the organisation hierarchy.
+
+The index is loaded with two queries and then answers parent, child,
+ancestor, descendant and family questions with set lookups instead of the
+recursive CTEs behind ``Group.get_parent_group_hierarchy`` and
+``Group.get_children_group_hierarchy``.
+
+It is refreshed for a single organisation whenever the hierarchy is changed
+through the action API (see ``subscriptions``), and reloaded completely after
+``ckan.workflow.hierarchy_cache_ttl`` seconds so that changes made by other
+processes are picked up.
+
+``get_organization_summaries`` adds the names and titles of the organisations,
+for forms that list organisations without loading their ``Group`` objects.
+"""
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import Iterable, NamedTuple, Optional
+
+import ckan.model as model
+import ckan.plugins.toolkit as tk
+
+log = logging.getLogger(__name__)
+
+CONFIG_TTL = "ckan.workflow.hierarchy_cache_ttl"
+DEFAULT_TTL = 300
+
+
+class OrganizationHierarchy:
+    """Closure of the organisation hierarchy.
+
+    ``edges`` are (child_id, parent_id) pairs. As with the CKAN hierarchy
+    queries, the hierarchy is walked through every active membership but only
+    active organisations are returned.
+    """
+
+    def __init__(
+        self, edges: Iterable[tuple[str, str]], organization_ids: Iterable[str]
+    ):
+        self.edges = frozenset(edges)
+        self.organization_ids = frozenset(organization_ids)
+        self.version = hash((self.edges, self.organization_ids))
+
+        parents = defaultdict(set)
+        children = defaultdict(set)
+        for child_id, parent_id in self.edges:
+            parents[child_id].add(parent_id)
+            children[parent_id].add(child_id)
+        self._parents = {key: frozenset(value) for key, value in parents.items()}
+        self._children = {key: frozenset(value) for key, value in children.items()}
+
+        self._ancestors: dict[str, frozenset[str]] = {}
+        self._descendants: dict[str, frozenset[str]] = {}
+        self._family: dict[str, frozenset[str]] = {}
+
+    def _walk(self, graph: dict[str, frozenset[str]], organization_id: str) -> frozenset[str]:
+        seen = set()
+        pending = list(graph.get(organization_id, ()))
+        while pending:
+            current = pending.pop()
+            if current not in seen:
+                seen.add(current)
+                pending.extend(graph.get(current, ()))
+        seen.discard(organization_id)
+        return frozenset(seen & self.organization_ids)
+
+    def parents(self, organization_id: str) -> frozenset[str]:
+        return self._parents.get(organization_id, frozenset()) & self.organization_ids
+
+    def children(self, organization_id: str) -> frozenset[str]:
+        return self._children.get(organization_id, frozenset()) & self.organization_ids
+
+    def ancestors(self, organization_id: str) -> frozenset[str]:
+        if organization_id not in self._ancestors:
+            self._ancestors[organization_id] = self._walk(self._parents, organization_id)
+        return self._ancestors[organization_id]
+
+    def descendants(self, organization_id: str) -> frozenset[str]:
+        if organization_id not in self._descendants:
+            self._descendants[organization_id] = self._walk(self._children, organization_id)
+        return self._descendants[organization_id]
+
+    def family(self, organization_id: str) -> frozenset[str]:
+        """The organisation's ancestors and everything below them."""
+        if organization_id not in self._family:
+            family = set(self.ancestors(organization_id))
+            for ancestor_id in self.ancestors(organization_id):
+                family.update(self.descendants(ancestor_id))
+            self._family[organization_id] = frozenset(family)
+        return self._family[organization_id]
+
+    def tree(self, organization_id: str) -> frozenset[str]:
+        """Every organisation in the same tree as the organisation."""
+        return (
+            self.family(organization_id)
+            | self.descendants(organization_id)
+            | {organization_id}
+        )
+
+    def replace_parents(
+        self, organization_id: str, parent_ids: Iterable[str], active: bool
+    ) -> OrganizationHierarchy:
+        """Return a copy of the index with the organisation's parents replaced."""
+        edges = {edge for edge in self.edges if edge[0] != organization_id}
+        edges.update((organization_id, parent_id) for parent_id in parent_ids)
+        organization_ids = set(self.organization_ids)
+        if active:
+            organization_ids.add(organization_id)
+        else:
+            organization_ids.discard(organization_id)
+        return OrganizationHierarchy(edges, organization_ids)
+
+
+def _hierarchy_edges(child_id: Optional[str] = None):
+    query = model.Session.query(model.Member.table_id, model.Member.group_id).filter(
+        model.Member.table_name == "group",
+        model.Member.state == "active",
+    )
+    if child_id:
+        query = query.filter(model.Member.table_id == child_id)
+    return query
+
+
+def load_hierarchy() -> OrganizationHierarchy:
+    organization_ids = model.Session.query(model.Group.id).filter(
+        model.Group.type == "organization",
+        model.Group.state == "active",
+    )
+    return OrganizationHierarchy(
+        ((row.table_id, row.group_id) for row in _hierarchy_edges()),
+        (row.id for row in organization_ids),
+    )
+
+
+_lock = threading.Lock()
+_hierarchy: Optional[OrganizationHierarchy] = None
+_loaded_at = 0.0
+
+
+def get_hierarchy() -> OrganizationHierarchy:
+    """Return the organisation hierarchy index, loading it if needed."""
+    global _hierarchy, _loaded_at
+
+    ttl = tk.asint(tk.config.get(CONFIG_TTL, DEFAULT_TTL))
+    hierarchy = _hierarchy
+    if hierarchy is None or time.monotonic() - _loaded_at > ttl:
+        with _lock:
+            if _hierarchy is hierarchy:
+                _hierarchy = load_hierarchy()
+                _loaded_at = time.monotonic()
+                log.debug("Loaded hierarchy of %d organisations", len(_hierarchy.organization_ids))
+            hierarchy = _hierarchy
+    return hierarchy
+
+
+def reload_hierarchy() -> OrganizationHierarchy:
+    """Load the index from the database now, and share it with later
+    ``get_hierarchy`` calls.
+
+    For decisions that outlive the cached index, e.g. what gets indexed in
+    Solr, which ``get_hierarchy`` may serve from an index up to
+    ``ckan.workflow.hierarchy_cache_ttl`` seconds old.
+    """
+    global _hierarchy, _loaded_at
+
+    hierarchy = load_hierarchy()
+    with _lock:
+        _hierarchy = hierarchy
+        _loaded_at = time.monotonic()
+    return hierarchy
+
+
+def loaded_hierarchy() -> Optional[OrganizationHierarchy]:
+    """The index as currently loaded in this process, without loading it."""
+    return _hierarchy
+
+
+def refresh_organization(organization_id: str) -> frozenset[str]:
+    """Reload the parents of a single organisation after it has changed.
+
+    Returns the organisations whose place in the hierarchy may have changed,
+    i.e. the trees the organisation was moved out of and into. When the index
+    was not loaded yet, only the tree it is in now is known.
+    """
+    global _hierarchy, _loaded_at
+
+    with _lock:
+        group = model.Group.get(organization_id)
+        if group is None:
+            # Purged, start again from scratch
+            _hierarchy = None
+            return frozenset()
+
+        if _hierarchy is None:
+            _hierarchy = load_hierarchy()
+            _loaded_at = time.monotonic()
+            return _hierarchy.tree(group.id)
+
+        before = _hierarchy
+        parent_ids = frozenset(row.group_id for row in _hierarchy_edges(group.id))
+        active = group.type == "organization" and group.state == "active"
+        if (
+            before._parents.get(group.id, frozenset()) == parent_ids
+            and (group.id in before.organization_ids) == active
+        ):
+            return frozenset()
+
+        _hierarchy = before.replace_parents(group.id, parent_ids, active)
+        return before.tree(group.id) | _hierarchy.tree(group.id)
+
+
+def invalidate():
+    """Drop the index, it will be loaded again on next use."""
+    global _hierarchy
+
+    with _lock:
+        _hierarchy = None
+
+
+class OrganizationSummary(NamedTuple):
+    id: str
+    name: str
+    title: str
+    parent_id: Optional[str]
+
+
+_names_lock = threading.Lock()
+_names: Optional[dict[str, tuple[str, str]]] = None
+_names_loaded_at = 0.0
+_names_generation = 0
+_summaries: tuple[
+    Optional[tuple[int, int]],
+    tuple[OrganizationSummary, ...],
+    dict[str, OrganizationSummary],
+] = (None, (), {})
+
+
+def _organization_names() -> tuple[int, dict[str, tuple[str, str]]]:
+    global _names, _names_loaded_at, _names_generation
+
+    ttl = tk.asint(tk.config.get(CONFIG_TTL, DEFAULT_TTL))
+    with _names_lock:
+        if _names is None or time.monotonic() - _names_loaded_at > ttl:
+            rows = model.Session.query(
+                model.Group.id, model.Group.name, model.Group.title
+            ).filter(
+                model.Group.type == "organization",
+                model.Group.state == "active",
+            )
+            _names = {row.id: (row.name, row.title or row.name) for row in rows}
+            _names_loaded_at = time.monotonic()
+            _names_generation += 1
+        return _names_generation, _names
+
+
+def _load_summaries() -> tuple[
+    tuple[OrganizationSummary, ...], dict[str, OrganizationSummary]
+]:
+    global _summaries
+
+    organizations = get_hierarchy()
+    generation, names = _organization_names()
+    key = (organizations.version, generation)
+    cached_key, summaries, lookup = _summaries
+    if cached_key != key:
+        summaries = tuple(
+            sorted(
+                (
+                    OrganizationSummary(
+                        organization_id,
+                        name,
+                        title,
+                        min(organizations.parents(organization_id), default=None),
+                    )
+                    for organization_id, (name, title) in names.items()
+                ),
+                key=lambda summary: (summary.title.lower(), summary.name),
+            )
+        )
+        lookup = {summary.id: summary for summary in summaries}
+        lookup.update((summary.name, summary) for summary in summaries)
+        _summaries = (key, summaries, lookup)
+    return summaries, lookup
+
+
+def get_organization_summaries() -> tuple[OrganizationSummary, ...]:
+    """Active organisations with their parent, sorted by title.
+
+    Rebuilt when the hierarchy index changes, or when an organisation is
+    created, renamed or removed.
+    """
+    return _load_summaries()[0]
+
+
+def get_organization_summary(organization: str) -> Optional[OrganizationSummary]:
+    """The summary of an active organisation, by id or name."""
+    return _load_summaries()[1].get(organization)
+
+
+def allowed_parents(
+    organization_id: Optional[str] = None,
+) -> list[OrganizationSummary]:
+    """Organisations that can be the parent of the organisation (id or name).
+
+    Like ``Group.groups_allowed_to_be_its_parent``, an organisation cannot be
+    the parent of itself or of any organisation above it.
+    """
+    summaries, lookup = _load_summaries()
+    if not organization_id:
+        return list(summaries)
+
+    # Forms may identify the organisation by name
+    if organization_id in lookup:
+        organization_id = lookup[organization_id].id
+    excluded = get_hierarchy().descendants(organization_id) | {organization_id}
+    return [summary for summary in summaries if summary.id not in excluded]
+
+
+def invalidate_names():
+    """Drop the organisation names, they will be loaded again on next use."""
+    global _names
+
+    with _names_lock:
+        _names = None
@@ -1,10 +1,10 @@
 import ckan.authz as authz
-import ckan.model as model
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 import logging
 
-from ckanext.workflow import helpers
+from ckanext.workflow import helpers, hierarchy
+from ckan.exceptions import CkanConfigurationException
 from ckan.lib.plugins import DefaultOrganizationForm
 
 log = logging.getLogger(__name__)
@@ -14,8 +14,21 @@ class DataVicHierarchyForm(plugins.SingletonPlugin, DefaultOrganizationForm):
 
     plugins.implements(plugins.ITemplateHelpers)
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.IGroupForm, inherit=True)
 
+    ## IConfigurable interface ##
+
+    def configure(self, config):
+        # The parent organisation autocomplete action and the clearing of the
+        # cached hierarchy when organisations change are provided by the
+        # workflow plugin
+        if not plugins.plugin_loaded('workflow'):
+            raise CkanConfigurationException(
+                'The datavic_hierarchy_form plugin needs the workflow plugin, '
+                'add workflow to ckan.plugins'
+            )
+
     ## IConfigurer interface ##
 
     def update_config(self, config):
@@ -45,16 +58,12 @@ class DataVicHierarchyForm(plugins.SingletonPlugin, DefaultOrganizationForm):
         #  DataVic - we filter these in context of logged in user
         user = toolkit.g.userobj
 
-        if authz.is_sysadmin(user.name):
-            toolkit.g.allowable_parent_groups = model.Group.all(
-                group_type='organization')
+        # The allowable parents are listed from the cached organisation
+        # summaries (id, name, title, parent_id) rather than Group objects
+        group_id = data_dict.get('id')
+        if authz.is_sysadmin(user.name) or group_id:
+            toolkit.g.allowable_parent_groups = hierarchy.allowed_parents(group_id)
         else:
-            group_id = data_dict.get('id')
-            if group_id:
-                group = model.Group.get(group_id)
-                toolkit.g.allowable_parent_groups = \
-                    group.groups_allowed_to_be_its_parent(type='organization')
-            else:
-                context = {'user': toolkit.g.user}
-                data_dict = {'permission': None}
-                toolkit.g.allowable_parent_groups = toolkit.get_action('organization_list_for_user')(context, data_dict)
+            context = {'user': toolkit.g.user}
+            data_dict = {'permission': None}
+            toolkit.g.allowable_parent_groups = toolkit.get_action('organization_list_for_user')(context, data_dict)
@@ -0,0 +1,184 @@
+"""Timing and SQL statement counts of the workflow hooks, auth functions and
+search filter builders.
+
+Functions wrapped with ``timed`` record, when ``ckan.workflow.instrumentation``
+is enabled:
+
+* their wall time,
+* the number of SQL statements issued while they ran, counted with an
+  SQLAlchemy ``before_cursor_execute`` listener,
+* the length of the fq they generated, for the search filter builders and
+  ``before_dataset_search``.
+
+Each call is logged as a JSON line on the ``ckanext.workflow.instrumentation``
+logger at INFO level. Totals per process can be exposed in the Prometheus
+text format at ``/workflow/metrics`` (``ckan.workflow.metrics_endpoint``), and
+the totals of the current request in an ``X-Workflow-Timing`` response header
+(``ckan.workflow.timing_header``).
+"""
+from __future__ import annotations
+
+import functools
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Optional, TypeVar
+
+from flask import Blueprint, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import ckan.plugins.toolkit as tk
+
+from ckanext.workflow.cache import request_cache
+
+log = logging.getLogger(__name__)
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+_enabled = False
+_local = threading.local()
+_totals_lock = threading.Lock()
+# name -> [calls, seconds, SQL statements, fq characters]
+_totals: defaultdict[str, list[float]] = defaultdict(lambda: [0, 0.0, 0, 0])
+
+
+def metrics_endpoint_enabled() -> bool:
+    return tk.asbool(tk.config.get("ckan.workflow.metrics_endpoint", False))
+
+
+def timing_header_enabled() -> bool:
+    return tk.asbool(tk.config.get("ckan.workflow.timing_header", False))
+
+
+def configure():
+    """Start or stop measuring, following the CKAN config."""
+    global _enabled
+
+    enabled = tk.asbool(tk.config.get("ckan.workflow.instrumentation", False))
+    if enabled and not event.contains(Engine, "before_cursor_execute", _count_statement):
+        event.listen(Engine, "before_cursor_execute", _count_statement)
+    elif not enabled and event.contains(
+        Engine, "before_cursor_execute", _count_statement
+    ):
+        event.remove(Engine, "before_cursor_execute", _count_statement)
+    _enabled = enabled
+
+
+def _count_statement(*args: Any, **kwargs: Any):
+    _local.statements = getattr(_local, "statements", 0) + 1
+
+
+def _fq_length(value: Any) -> Optional[int]:
+    # Filter builders return the fq, before_dataset_search the search params
+    if isinstance(value, dict):
+        return len(value.get("fq") or "") + sum(
+            len(fq) for fq in value.get("fq_list") or []
+        )
+    return len(value) if isinstance(value, str) else None
+
+
+def _record(name: str, seconds: float, statements: int, fq_length: Optional[int]):
+    with _totals_lock:
+        totals = _totals[name]
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] += statements
+        totals[3] += fq_length or 0
+
+    timings = request_cache("instrumentation")
+    if timings is not None:
+        request_totals = timings.setdefault(name, [0, 0.0, 0])
+        request_totals[0] += 1
+        request_totals[1] += seconds
+        request_totals[2] += statements
+
+    record = {
+        "event": "workflow_timing",
+        "name": name,
+        "ms": round(seconds * 1000, 3),
+        "sql_statements": statements,
+    }
+    if fq_length is not None:
+        record["fq_length"] = fq_length
+    log.info(json.dumps(record))
+
+
+def timed(name: str) -> Callable[[F], F]:
+    """Measure calls of the decorated function under ``name``."""
+
+    def decorator(func: F) -> F:
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if not _enabled:
+                return func(*args, **kwargs)
+
+            statements = getattr(_local, "statements", 0)
+            start = time.perf_counter()
+            return_value = None
+            try:
+                return_value = func(*args, **kwargs)
+                return return_value
+            finally:
+                _record(
+                    name,
+                    time.perf_counter() - start,
+                    getattr(_local, "statements", 0) - statements,
+                    _fq_length(return_value),
+                )
+
+        return wrapper  # type: ignore
+
+    return decorator
+
+
+def metrics() -> str:
+    """The totals of this process in the Prometheus text format."""
+    with _totals_lock:
+        totals = {name: list(values) for name, values in _totals.items()}
+
+    lines = []
+    for index, (metric, help_text) in enumerate(
+        [
+            ("ckanext_workflow_calls_total", "Calls of the function"),
+            ("ckanext_workflow_seconds_total", "Wall time spent in the function"),
+            (
+                "ckanext_workflow_sql_statements_total",
+                "SQL statements issued by the function",
+            ),
+            (
+                "ckanext_workflow_fq_characters_total",
+                "Characters of search filter generated by the function",
+            ),
+        ]
+    ):
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} counter")
+        for name, values in sorted(totals.items()):
+            lines.append(f'{metric}{{function="{name}"}} {values[index]}')
+    return "\n".join(lines) + "\n"
+
+
+def _metrics_view() -> Response:
+    return Response(metrics(), mimetype="text/plain; version=0.0.4")
+
+
+def _add_timing_header(response: Response) -> Response:
+    timings = request_cache("instrumentation")
+    if timings:
+        response.headers["X-Workflow-Timing"] = ", ".join(
+            f"{name};dur={seconds * 1000:.1f};count={calls};sql={statements}"
+            for name, (calls, seconds, statements) in sorted(timings.items())
+        )
+    return response
+
+
+def get_blueprints() -> list[Blueprint]:
+    blueprint = Blueprint("workflow_instrumentation", __name__)
+    if metrics_endpoint_enabled():
+        blueprint.add_url_rule("/workflow/metrics", view_func=_metrics_view)
+    if timing_header_enabled():
+        blueprint.after_app_request(_add_timing_header)
+    return [blueprint]
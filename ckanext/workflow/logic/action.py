@@ -0,0 +1,372 @@
+from __future__ import annotations
+
+import datetime
+from collections import defaultdict
+
+import ckan.authz as authz
+import ckan.model as model
+import ckan.plugins.toolkit as tk
+import ckan.types as types
+from sqlalchemy import and_, exists, or_
+from sqlalchemy.orm import aliased, joinedload
+
+from ckanext.workflow import harvest, helpers, hierarchy, notifications
+from ckanext.workflow.model import WorkflowTransition, record_transition
+
+# Most datasets a single workflow_bulk_transition call will change
+BULK_TRANSITION_LIMIT = 1000
+# Most datasets a single workflow_filter_visible call will check
+FILTER_VISIBLE_LIMIT = 1000
+# Most organisations a single workflow_organization_autocomplete call returns
+AUTOCOMPLETE_LIMIT = 100
+
+
+def get_actions():
+    return {
+        "workflow_transition_list": workflow_transition_list,
+        "workflow_stale_dataset_list": workflow_stale_dataset_list,
+        "workflow_bulk_transition": workflow_bulk_transition,
+        "workflow_filter_visible": workflow_filter_visible,
+        "workflow_organization_autocomplete": workflow_organization_autocomplete,
+        "package_create": package_create,
+        "package_update": package_update,
+    }
+
+
+@tk.chained_action
+def package_create(
+    next_action: types.Action, context: types.Context, data_dict: types.DataDict
+):
+    if context.get(harvest.CONTEXT_KEY):
+        with harvest.harvest_mode():
+            return next_action(context, data_dict)
+    return next_action(context, data_dict)
+
+
+@tk.chained_action
+def package_update(
+    next_action: types.Action, context: types.Context, data_dict: types.DataDict
+):
+    if context.get(harvest.CONTEXT_KEY):
+        with harvest.harvest_mode():
+            return next_action(context, data_dict)
+    return next_action(context, data_dict)
+
+
+@tk.side_effect_free
+def workflow_transition_list(
+    context: types.Context, data_dict: types.DataDict
+) -> list[dict]:
+    """Return the workflow status changes of a dataset, oldest first.
+
+    :param id: the id or name of the dataset
+    :type id: string
+
+    :rtype: list of dictionaries
+    """
+    package = model.Package.get(tk.get_or_bust(data_dict, "id"))
+    if not package:
+        raise tk.ObjectNotFound("Dataset not found")
+
+    tk.check_access("workflow_transition_list", context, {"id": package.id})
+
+    transitions = (
+        model.Session.query(WorkflowTransition)
+        .filter(WorkflowTransition.package_id == package.id)
+        .order_by(WorkflowTransition.timestamp)
+    )
+    return [transition.as_dict() for transition in transitions]
+
+
+@tk.side_effect_free
+def workflow_stale_dataset_list(
+    context: types.Context, data_dict: types.DataDict
+) -> list[dict]:
+    """Return the datasets that have been in a workflow status for more than
+    a number of days, grouped by organisation.
+
+    :param workflow_status: the workflow status (optional, default:
+        ``ready_for_approval``)
+    :type workflow_status: string
+    :param days: minimum number of days in the workflow status (optional,
+        default: ``0``)
+    :type days: int
+    :param owner_org: only return datasets of this organisation (optional)
+    :type owner_org: string
+
+    :rtype: list of dictionaries with the ``owner_org`` and its ``datasets``
+    """
+    tk.check_access("workflow_stale_dataset_list", context, data_dict)
+
+    workflow_status = data_dict.get("workflow_status", "ready_for_approval")
+    try:
+        days = int(data_dict.get("days", 0))
+    except (TypeError, ValueError):
+        raise tk.ValidationError({"days": ["Must be a whole number of days"]})
+
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    later = aliased(WorkflowTransition)
+
+    # The last transition of each dataset, if it moved into the status before the cutoff
+    query = (
+        model.Session.query(WorkflowTransition, model.Package.name)
+        .join(model.Package, model.Package.id == WorkflowTransition.package_id)
+        .filter(
+            WorkflowTransition.to_status == workflow_status,
+            WorkflowTransition.timestamp <= cutoff,
+            model.Package.state == "active",
+            ~exists().where(
+                and_(
+                    later.package_id == WorkflowTransition.package_id,
+                    later.timestamp > WorkflowTransition.timestamp,
+                )
+            ),
+        )
+        .order_by(WorkflowTransition.owner_org, WorkflowTransition.timestamp)
+    )
+
+    owner_org = data_dict.get("owner_org")
+    if owner_org:
+        organization = model.Group.get(owner_org)
+        if not organization:
+            raise tk.ObjectNotFound("Organization not found")
+        query = query.filter(WorkflowTransition.owner_org == organization.id)
+
+    datasets = defaultdict(list)
+    for transition, name in query:
+        datasets[transition.owner_org].append(
+            {
+                "id": transition.package_id,
+                "name": name,
+                "since": transition.timestamp.isoformat(),
+                "user_id": transition.user_id,
+            }
+        )
+
+    return [
+        {"owner_org": organization_id, "datasets": organization_datasets}
+        for organization_id, organization_datasets in datasets.items()
+    ]
+
+
+@tk.side_effect_free
+def workflow_filter_visible(
+    context: types.Context, data_dict: types.DataDict
+) -> list[str]:
+    """Return the datasets the user can see, out of a list of datasets.
+
+    This gives the same answer as calling ``package_show`` for each dataset,
+    but loads all of them in a single query.
+
+    :param ids: ids or names of the datasets
+    :type ids: list of strings
+
+    :returns: the ids of the visible datasets, in the order given
+    :rtype: list of strings
+    """
+    tk.check_access("workflow_filter_visible", context, data_dict)
+
+    ids = tk.aslist(tk.get_or_bust(data_dict, "ids"))
+    if len(ids) > FILTER_VISIBLE_LIMIT:
+        raise tk.ValidationError(
+            {"ids": [f"At most {FILTER_VISIBLE_LIMIT} datasets can be checked at once"]}
+        )
+
+    return helpers.filter_visible_datasets(context.get("user"), ids)
+
+
+@tk.side_effect_free
+def workflow_organization_autocomplete(
+    context: types.Context, data_dict: types.DataDict
+) -> list[dict]:
+    """Return organisations whose name or title contains a search term,
+    for choosing the parent of an organisation.
+
+    Organisations are listed from a cached summary of the organisation
+    hierarchy, sorted by title.
+
+    :param q: the search term (optional, default: all organisations)
+    :type q: string
+    :param id: the id or name of the organisation the parent is chosen for;
+        it and the organisations below it are left out (optional)
+    :type id: string
+    :param limit: the maximum number of organisations to return (optional,
+        default: ``20``, maximum: ``100``)
+    :type limit: int
+    :param offset: the number of matching organisations to skip (optional,
+        default: ``0``)
+    :type offset: int
+
+    :rtype: list of dictionaries with the ``id``, ``name``, ``title`` and
+        ``parent_id`` of the organisations
+    """
+    tk.check_access("workflow_organization_autocomplete", context, data_dict)
+
+    try:
+        limit = min(int(data_dict.get("limit", 20)), AUTOCOMPLETE_LIMIT)
+        offset = max(int(data_dict.get("offset", 0)), 0)
+    except (TypeError, ValueError):
+        raise tk.ValidationError({"limit": ["limit and offset must be whole numbers"]})
+
+    q = (data_dict.get("q") or "").strip().lower()
+    organizations = hierarchy.allowed_parents(data_dict.get("id"))
+    if q:
+        organizations = [
+            organization
+            for organization in organizations
+            if q in organization.name.lower() or q in organization.title.lower()
+        ]
+
+    return [
+        organization._asdict()
+        for organization in organizations[offset : offset + limit]
+    ]
+
+
+def workflow_bulk_transition(
+    context: types.Context, data_dict: types.DataDict
+) -> dict:
+    """Change the workflow status of many datasets at once.
+
+    Each change is checked against the workflow transitions allowed for the
+    user's role in the dataset's organisation. All allowed changes are saved
+    in one transaction and indexed in one batch, and one notification email
+    is sent per recipient.
+
+    Unlike ``package_patch``, this does not call the ``IPackageController``
+    hooks of other plugins or create activities.
+
+    :param ids: ids or names of the datasets (optional if ``q`` is given)
+    :type ids: list of strings
+    :param q: a search query selecting the datasets (optional if ``ids`` is given)
+    :type q: string
+    :param workflow_status: the new workflow status
+    :type workflow_status: string
+    :param workflow_status_notes: notes to store with the change (optional)
+    :type workflow_status_notes: string
+    :param private: whether datasets published with organisation visibility
+        ``all`` stay private (optional, defaults to their current value).
+        Other datasets are always private.
+    :type private: bool
+
+    :returns: the ids of the ``updated`` datasets, and ``errors`` by dataset id
+    :rtype: dictionary
+    """
+    tk.check_access("workflow_bulk_transition", context, data_dict)
+
+    workflow_status = tk.get_or_bust(data_dict, "workflow_status")
+    notes = data_dict.get("workflow_status_notes")
+    user = context.get("auth_user_obj") or model.User.get(context.get("user"))
+    if user is None:
+        raise tk.NotAuthorized("A user is needed to change workflow statuses")
+
+    ids = tk.aslist(data_dict.get("ids"))
+    if data_dict.get("q"):
+        result = tk.get_action("package_search")(
+            context.copy(),
+            {
+                "q": data_dict["q"],
+                "fl": "id",
+                "rows": BULK_TRANSITION_LIMIT,
+                "include_private": True,
+            },
+        )
+        if result["count"] > BULK_TRANSITION_LIMIT:
+            raise tk.ValidationError(
+                {
+                    "q": [
+                        f"The query matches {result['count']} datasets, at most "
+                        f"{BULK_TRANSITION_LIMIT} can be changed at once"
+                    ]
+                }
+            )
+        ids.extend(package["id"] for package in result["results"])
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        raise tk.ValidationError({"ids": ["Provide dataset ids or a search query"]})
+    if len(ids) > BULK_TRANSITION_LIMIT:
+        raise tk.ValidationError(
+            {"ids": [f"At most {BULK_TRANSITION_LIMIT} datasets can be changed at once"]}
+        )
+
+    sysadmin = authz.is_sysadmin(user.name)
+    roles = helpers.get_user_roles(user.name)
+
+    packages = (
+        model.Session.query(model.Package)
+        .options(joinedload(model.Package._extras))
+        .filter(or_(model.Package.id.in_(ids), model.Package.name.in_(ids)))
+        .filter(model.Package.state != "deleted")
+        .all()
+    )
+
+    errors = {}
+    transitions = []
+    now = datetime.datetime.utcnow()
+    for package in packages:
+        role = roles.get(package.owner_org)
+        if not sysadmin and role not in ["admin", "editor"]:
+            errors[package.id] = "Not authorized to update this dataset"
+            continue
+
+        previous_workflow_status = package.extras.get("workflow_status")
+        if previous_workflow_status == workflow_status:
+            continue
+        if (
+            helpers.resolve_workflow_status(
+                previous_workflow_status, workflow_status, role, sysadmin
+            )
+            != workflow_status
+        ):
+            errors[package.id] = (
+                f"Cannot change workflow status from {previous_workflow_status} to {workflow_status}"
+            )
+            continue
+
+        package.extras["workflow_status"] = workflow_status
+        if notes:
+            package.extras["workflow_status_notes"] = notes
+
+        # DATAVIC-108: Only sysadmins and organisation admins can release
+        # published datasets visible to all organisations
+        if (
+            workflow_status == "published"
+            and package.extras.get("organization_visibility") == "all"
+            and (sysadmin or role == "admin")
+        ):
+            package.private = tk.asbool(data_dict.get("private", package.private))
+        else:
+            package.private = True
+
+        package.metadata_modified = now
+        record_transition(package, previous_workflow_status, workflow_status, user.id, notes)
+        transitions.append((package, previous_workflow_status, workflow_status))
+
+    found = {package.id for package in packages} | {package.name for package in packages}
+    for missing in set(ids) - found:
+        errors[missing] = "Dataset not found"
+
+    if transitions:
+        items = helpers.workflow_transition_notifications(transitions, user.name)
+        digest = notifications.digest_interval()
+        if digest:
+            # Queued in the same transaction as the status changes
+            helpers.queue_workflow_transition_digests(items)
+        model.repo.commit()
+
+        from ckan.lib.search import commit, rebuild
+
+        rebuild(
+            package_ids=[package.id for package, _, _ in transitions],
+            defer_commit=True,
+            quiet=True,
+        )
+        commit()
+
+        if not digest:
+            helpers.send_workflow_transition_emails(items)
+
+    return {
+        "updated": [package.id for package, _, _ in transitions],
+        "errors": errors,
+    }
@@ -1,96 +1,186 @@
 from __future__ import annotations
 
 import logging
+from collections import defaultdict
+from typing import Iterable
 
 import ckan.model as model
 import ckan.plugins.toolkit as toolkit
 import ckan.lib.plugins as lib_plugins
 
-from ckanext.workflow import helpers
+from ckanext.workflow import helpers, hierarchy, instrumentation
+from ckanext.workflow.cache import TTLCache
+from ckanext.workflow.logic import visibility
 
 log1 = logging.getLogger(__name__)
 config = toolkit.config
 
+# Above this many organisations a single owner_org rule uses the terms query parser
+TERMS_QUERY_THRESHOLD = 64
 
-def organization_read_filter_query(organization_id, username):
+# Organisation rules of the dataset search filter, keyed by user, memberships
+# and hierarchy version so that any membership or hierarchy change misses
+filter_cache = TTLCache(
+    "ckan.workflow.filter_cache_size", "ckan.workflow.filter_cache_ttl"
+)
+
+# Rules of the organisation page filter, keyed by organisation, user,
+# memberships and hierarchy version
+organization_filter_cache = TTLCache(
+    "ckan.workflow.filter_cache_size", "ckan.workflow.filter_cache_ttl"
+)
+
+# The dataset states shown in dataset searches, instead of CKAN's default
+# active only, so that users find the drafts they created
+VISIBLE_STATES = "+state:(draft OR active)"
+# Datasets any logged in user can see
+PUBLISHED_TO_ALL = 'filter(organization_visibility:"all" AND workflow_status:"published")'
+
+
+@instrumentation.timed("queries.organization_read_filter_query")
+def organization_read_filter_query(
+    organization_id: str, user: model.User | model.AnonymousUser
+):
     log1.debug(
-        "*** PACKAGE_SEARCH | organization_read_filter_query | organization_id: %s ***"
-        % organization_id
+        "*** PACKAGE_SEARCH | organization_read_filter_query | organization_id: %s ***",
+        organization_id,
     )
 
-    organization = model.Group.get(organization_id)
-    user = model.User.get(username)
+    if user.is_anonymous:
+        return ""
 
-    rules = []
+    # The hierarchy index only knows organisations by id
+    summary = hierarchy.get_organization_summary(organization_id)
+    if summary:
+        organization_id = summary.id
+
+    roles = helpers.get_user_roles(user.name)
+    organizations = hierarchy.get_hierarchy()
+
+    # Reused across the pages and facet refinements of the organisation page
+    cache_key = (
+        organization_id,
+        user.id,
+        user.sysadmin,
+        roles.fingerprint,
+        organizations.version,
+    )
+    rules = organization_filter_cache.get(cache_key)
+    if rules is None:
+        rules = _organization_read_rules(organization_id, user, roles)
+        organization_filter_cache.set(cache_key, rules)
+
+    rules = list(rules)
+    if toolkit.config["ckan.auth.allow_dataset_collaborators"]:
+        add_collaborators_filter(rules, user)
+
+    return any_of(rules)
 
-    if not user:
-        return ""
 
-    role = helpers.role_in_org(organization_id, username)
+def _organization_read_rules(
+    organization_id: str, user: model.User, roles: helpers.UserRoles
+) -> tuple[str, ...]:
+    role = roles.get(organization_id)
+    rules = []
 
     if role or user.sysadmin:
         log1.debug(
             "*** User belongs to organization `%s` | role: %s - no further querying required ***",
-            organization.name,
+            organization_id,
             role,
         )
         # Of course the user can see any datasets they have created
         rules.append(f'(owner_org:"{organization_id}" AND creator_user_id:"{user.id}")')
         # Admin can see unpublished datasets in organisations they are members of
         if role in ["admin", "editor"] or user.sysadmin:
-            rules.append(f'(owner_org:"{organization_id}")')
+            rules.append(cached_clause(f'owner_org:"{organization_id}"'))
         else:
             # The user can see any published datasets in their own organisation
-            rules.append(f'(capacity:public AND owner_org:"{organization_id}")')
+            rules.append(cached_clause(f'capacity:public AND owner_org:"{organization_id}"'))
+    elif visibility.is_enabled():
+        rules.append(
+            cached_clause(
+                f'owner_org:"{organization_id}" AND organization_visibility:"all" AND workflow_status:"published"'
+            )
+        )
+        user_filter = visibility.user_filter_query(user, roles, published_only=True)
+        if user_filter:
+            rules.append(cached_clause(f'owner_org:"{organization_id}" AND {user_filter}'))
     else:
-        user_organizations = helpers.get_user_organizations(username)
         relationships = helpers.get_organization_relationships_for_user(
-            organization, user_organizations
+            organization_id, roles.organization_ids
         )
-        if relationships:
-            for relationship in relationships:
-                rules.append(
-                    f'(owner_org:"{organization_id}" AND organization_visibility:"{relationship}" AND workflow_status:"published")'
+        for relationship in relationships:
+            rules.append(
+                cached_clause(
+                    f'owner_org:"{organization_id}" AND organization_visibility:"{relationship}" AND workflow_status:"published"'
                 )
+            )
 
-    if toolkit.config["ckan.auth.allow_dataset_collaborators"]:
-        add_collaborators_filter(rules, user)
-
-    rules = " ( {0} ) ".format(" OR ".join(rule for rule in rules))
-
-    return rules
+    return tuple(rules)
 
 
+@instrumentation.timed("queries.package_search_filter_query")
 def package_search_filter_query(user: model.User | model.AnonymousUser):
     # Return early if private site and non-logged in user..
 
     if user.is_anonymous:
         return ""
 
-    user_organizations = user.get_groups("organization")
-
     # All logged in users can see:
     # - any datasets with organization_visibility set to All and workflow_status set to published
-    # - "any unpublished records they have created themselves" (from client 18/10/2017)
+    # - "any unpublished records they have created themselves" (from client 18/10/2017),
+    #   as long as the search is restricted to VISIBLE_STATES
     rules = [
-        '(organization_visibility:"all" AND workflow_status:"published")',
-        f"(creator_user_id:{user.id} AND +state:(draft OR active))",
+        PUBLISHED_TO_ALL,
+        f'creator_user_id:"{user.id}"',
     ]
 
     if toolkit.config["ckan.auth.allow_dataset_collaborators"]:
         add_collaborators_filter(rules, user)
 
-    for organization in user_organizations:
-        role = helpers.role_in_org(organization.id, user.name)
+    roles = helpers.get_user_roles(user.name)
+
+    # The organisations that can see each dataset are indexed with it
+    if visibility.is_enabled():
+        user_filter = visibility.user_filter_query(user, roles)
+        if user_filter:
+            rules.append(cached_clause(user_filter))
+        return any_of(rules)
+
+    organizations = hierarchy.get_hierarchy()
+
+    cache_key = (user.id, user.sysadmin, roles.fingerprint, organizations.version)
+    organization_rules = filter_cache.get(cache_key)
+    if organization_rules is None:
+        organization_rules = _organization_rules(user, roles, organizations)
+        filter_cache.set(cache_key, organization_rules)
+
+    rules.extend(organization_rules)
+
+    return any_of(rules)
+
+
+def _organization_rules(
+    user: model.User,
+    roles: helpers.UserRoles,
+    organizations: hierarchy.OrganizationHierarchy,
+) -> tuple[str, ...]:
+    # Owner organisations are grouped by the rule they need, so each kind of
+    # rule is emitted once for all of them rather than once per organisation
+    unrestricted = set()
+    published = set()
+    related = defaultdict(set)
+
+    for organization_id in roles.organization_ids:
+        role = roles.get(organization_id)
 
         # Any user within the organisation that owns the dataset can see it
         # Unsure about this rule -- need to check with client..
         if role == "admin":
-            rules.append(f'(owner_org:"{organization.id}")')
+            unrestricted.add(organization_id)
         else:
-            rules.append(
-                f'(owner_org:"{organization.id}" AND workflow_status:"published")'
-            )
+            published.add(organization_id)
 
         """
         PLEASE NOTE: These rules MAY appear to be labelled incorrectly
@@ -102,34 +192,82 @@ def package_search_filter_query(user: model.User | model.AnonymousUser):
         # data records is limited to the Org ADMIN account holders and the EDITOR account
         # holder who created the data record itself
         if role in ["admin", "editor", "member"]:
-            if role == "admin" or user.sysadmin:
-                query = '(owner_org:"{0}" AND organization_visibility:"{1}")'
-            else:
-                # For 'editor' and 'member' users
-                query = '(owner_org:"{0}" AND organization_visibility:"{1}" AND workflow_status:"published")'
+            # 'editor' and 'member' users can only see published datasets
+            published_only = not (role == "admin" or user.sysadmin)
 
             # PARENT
             # Dataset Organisation Visibility = Parent -- Get this Organization's Child orgs...
-            for child in organization.get_children_groups("organization"):
-                rules.append(query.format(child.id, "parent"))
+            related[("parent", published_only)].update(
+                organizations.children(organization_id)
+            )
             # CHILD
             # Dataset Organisation Visibility = Child -- Get this Organization's Parent orgs...
-            for parent in organization.get_parent_groups("organization"):
-                rules.append(query.format(parent.id, "child"))
+            related[("child", published_only)].update(
+                organizations.parents(organization_id)
+            )
             # FAMILY
             # Dataset Organisation Visibility = Family -- Get this Organization's Ancestor & Descendent orgs...
-            for ancestor in organization.get_parent_group_hierarchy("organization"):
-                rules.append(query.format(ancestor.id, "family"))
-                descendants = ancestor.get_children_group_hierarchy("organization")
-                for descendant in descendants:
-                    rules.append(query.format(descendant.id, "family"))
+            family = related[("family", published_only)]
+            for ancestor_id in organizations.ancestors(organization_id):
+                family.add(ancestor_id)
+                family.update(organizations.descendants(ancestor_id))
+            family.update(organizations.descendants(organization_id))
+
+    rules = []
 
-            for descendant in organization.get_children_group_hierarchy("organization"):
-                rules.append(query.format(descendant.id, "family"))
+    if unrestricted:
+        rules.append(cached_clause(owner_org_clause(unrestricted)))
 
-    rules = " ( {0} ) ".format(" OR ".join(rule for rule in rules))
+    # Organisations already matched in full need no further rules
+    published -= unrestricted
+    if published:
+        rules.append(
+            cached_clause(f'{owner_org_clause(published)} AND workflow_status:"published"')
+        )
 
-    return rules
+    for (organization_visibility, published_only), organization_ids in sorted(related.items()):
+        organization_ids = organization_ids - unrestricted
+        if published_only:
+            organization_ids -= published
+        if not organization_ids:
+            continue
+
+        rule = f'{owner_org_clause(organization_ids)} AND organization_visibility:"{organization_visibility}"'
+        if published_only:
+            rule += ' AND workflow_status:"published"'
+        rules.append(cached_clause(rule))
+
+    return tuple(rules)
+
+
+def cached_clause(clause: str) -> str:
+    """Wrap a clause shared by many users' filters in ``filter()``.
+
+    Solr caches the datasets matched by each ``filter()`` clause in its
+    filterCache on its own, so they are reused by every filter containing the
+    clause rather than only by identical filters.
+    """
+    return f"filter({clause})"
+
+
+def any_of(rules: Iterable[str]) -> str:
+    return " ( {0} ) ".format(" OR ".join(rules))
+
+
+def owner_org_clause(organization_ids: Iterable[str]) -> str:
+    """Match datasets owned by any of the organisations."""
+    organization_ids = sorted(organization_ids)
+
+    # The terms query parser is not limited by maxBooleanClauses, but CKAN
+    # rejects local params unless the parser has been explicitly allowed
+    if len(organization_ids) > TERMS_QUERY_THRESHOLD and "terms" in toolkit.aslist(
+        config.get("ckan.search.solr_allowed_query_parsers", "")
+    ):
+        return '_query_:"{{!terms f=owner_org}}{0}"'.format(",".join(organization_ids))
+
+    return "owner_org:({0})".format(
+        " OR ".join(f'"{organization_id}"' for organization_id in organization_ids)
+    )
 
 
 def add_collaborators_filter(rules: list, user: model.User) -> list:
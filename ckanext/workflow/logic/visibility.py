@@ -0,0 +1,164 @@
+"""Precomputed dataset visibility, indexed in the ``workflow_visible_to_orgs`` field.
+
+Instead of expanding the user's organisation hierarchy into search rules on
+every search, each dataset is indexed with the organisations whose members
+can see it, and searches only filter on the user's own organisations.
+
+The field holds tokens of the form:
+
+``published:<org id>``
+    Any member of the organisation can see the dataset.
+``owner:<org id>``
+    Admins of the organisation can see the dataset.
+``related:<org id>``
+    Admins of the organisation, or sysadmin members, can see the dataset.
+
+This requires the following field in the Solr schema, and is only enabled
+when ``ckan.workflow.index_visibility`` is true::
+
+    <field name="workflow_visible_to_orgs" type="string" indexed="true" stored="false" multiValued="true" />
+"""
+from __future__ import annotations
+
+import contextlib
+import logging
+from contextvars import ContextVar
+from typing import Any, Iterable, Optional
+
+import ckan.model as model
+import ckan.plugins.toolkit as tk
+
+from ckanext.workflow import helpers, hierarchy
+
+log = logging.getLogger(__name__)
+
+FIELD = "workflow_visible_to_orgs"
+
+_batch_hierarchy: ContextVar[Optional[hierarchy.OrganizationHierarchy]] = ContextVar(
+    "workflow_batch_hierarchy", default=None
+)
+
+
+def is_enabled() -> bool:
+    return tk.asbool(tk.config.get("ckan.workflow.index_visibility", False))
+
+
+def related_organizations(
+    organization_id: str,
+    organization_visibility: str,
+    organizations: hierarchy.OrganizationHierarchy,
+) -> frozenset[str]:
+    """Organisations whose members can see datasets through their visibility.
+
+    This is the inverse of the user centric rules in
+    ``queries.package_search_filter_query``.
+    """
+    if organization_visibility == "parent":
+        return organizations.parents(organization_id)
+    if organization_visibility == "child":
+        return organizations.children(organization_id)
+    if organization_visibility == "family":
+        return organizations.family(organization_id) | organizations.descendants(
+            organization_id
+        )
+    return frozenset()
+
+
+def dataset_tokens(
+    pkg_dict: dict[str, Any], organizations: hierarchy.OrganizationHierarchy
+) -> list[str]:
+    owner_org = pkg_dict.get("owner_org")
+    if not owner_org:
+        return []
+
+    published = pkg_dict.get("workflow_status") == "published"
+    related = related_organizations(
+        owner_org, pkg_dict.get("organization_visibility"), organizations
+    )
+
+    tokens = [f"owner:{owner_org}"]
+    tokens.extend(f"related:{organization_id}" for organization_id in sorted(related))
+    if published:
+        tokens.append(f"published:{owner_org}")
+        tokens.extend(
+            f"published:{organization_id}" for organization_id in sorted(related)
+        )
+    return tokens
+
+
+def user_tokens(
+    user: model.User, roles: helpers.UserRoles, published_only: bool = False
+) -> list[str]:
+    tokens = []
+    for organization_id in sorted(roles.organization_ids):
+        role = roles.get(organization_id)
+        tokens.append(f"published:{organization_id}")
+        if published_only:
+            continue
+        if role == "admin":
+            tokens.append(f"owner:{organization_id}")
+        if role == "admin" or user.sysadmin:
+            tokens.append(f"related:{organization_id}")
+    return tokens
+
+
+def user_filter_query(
+    user: model.User, roles: helpers.UserRoles, published_only: bool = False
+) -> str:
+    """Match the datasets the user can see through their organisations."""
+    tokens = user_tokens(user, roles, published_only)
+    if not tokens:
+        return ""
+    return "{0}:({1})".format(FIELD, " OR ".join(f'"{token}"' for token in tokens))
+
+
+def index_dataset(pkg_dict: dict[str, Any]) -> dict[str, Any]:
+    # Tokens stay in the index until the dataset is indexed again, so they are
+    # computed from the hierarchy in the database rather than from this
+    # process' cached copy, unless a batch has already loaded it
+    organizations = _batch_hierarchy.get() or hierarchy.reload_hierarchy()
+    pkg_dict[FIELD] = dataset_tokens(pkg_dict, organizations)
+    return pkg_dict
+
+
+@contextlib.contextmanager
+def batch_hierarchy():
+    """Index the datasets of the block against one freshly loaded hierarchy."""
+    token = _batch_hierarchy.set(hierarchy.reload_hierarchy())
+    try:
+        yield
+    finally:
+        _batch_hierarchy.reset(token)
+
+
+def reindex_organizations(organization_ids: Iterable[str]):
+    """Background job: reindex the datasets owned by the organisations."""
+    from ckan.lib.search import commit, rebuild
+
+    organization_ids = list(organization_ids)
+    package_ids = [
+        row.id
+        for row in model.Session.query(model.Package.id).filter(
+            model.Package.owner_org.in_(organization_ids),
+            model.Package.state != "deleted",
+        )
+    ]
+    if package_ids:
+        with batch_hierarchy():
+            rebuild(package_ids=package_ids, defer_commit=True, quiet=True)
+        commit()
+    log.info(
+        "Reindexed %d datasets of %d organisations after a hierarchy change",
+        len(package_ids),
+        len(organization_ids),
+    )
+
+
+def enqueue_reindex(organization_ids: Iterable[str]):
+    organization_ids = sorted(organization_ids)
+    if organization_ids:
+        tk.enqueue_job(
+            reindex_organizations,
+            [organization_ids],
+            title="Reindex workflow visibility",
+        )
@@ -0,0 +1,40 @@
+"""Add workflow_notification table
+
+Revision ID: 5c2f4d9a8e1b
+Revises:
+Create Date: 2026-10-18 09:12:41.215334
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "5c2f4d9a8e1b"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "workflow_notification",
+        sa.Column("id", sa.UnicodeText, primary_key=True),
+        sa.Column("recipient_email", sa.UnicodeText, nullable=False),
+        sa.Column("kind", sa.UnicodeText, nullable=False),
+        sa.Column("package_name", sa.UnicodeText, nullable=False),
+        sa.Column("url", sa.UnicodeText, nullable=False),
+        sa.Column("organization", sa.UnicodeText),
+        sa.Column("user_name", sa.UnicodeText),
+        sa.Column("notes", sa.UnicodeText),
+        sa.Column("created", sa.DateTime, nullable=False),
+    )
+    op.create_index(
+        "idx_workflow_notification_recipient_created",
+        "workflow_notification",
+        ["recipient_email", "created"],
+    )
+
+
+def downgrade():
+    op.drop_table("workflow_notification")
@@ -0,0 +1,69 @@
+"""Add workflow_transition table
+
+Revision ID: 9a3e7b16c0d4
+Revises: 5c2f4d9a8e1b
+Create Date: 2026-10-18 11:40:07.902118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "9a3e7b16c0d4"
+down_revision = "5c2f4d9a8e1b"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "workflow_transition",
+        sa.Column("id", sa.UnicodeText, primary_key=True),
+        sa.Column("package_id", sa.UnicodeText, nullable=False),
+        sa.Column("owner_org", sa.UnicodeText),
+        sa.Column("from_status", sa.UnicodeText),
+        sa.Column("to_status", sa.UnicodeText),
+        sa.Column("user_id", sa.UnicodeText),
+        sa.Column("notes", sa.UnicodeText),
+        sa.Column("timestamp", sa.DateTime, nullable=False),
+    )
+    op.create_index(
+        "idx_workflow_transition_package_timestamp",
+        "workflow_transition",
+        ["package_id", "timestamp"],
+    )
+    op.create_index(
+        "idx_workflow_transition_org_status_timestamp",
+        "workflow_transition",
+        ["owner_org", "to_status", "timestamp"],
+    )
+    op.create_index(
+        "idx_workflow_transition_status_timestamp",
+        "workflow_transition",
+        ["to_status", "timestamp"],
+    )
+    # Start the history of existing datasets with their current status, as of
+    # their last modification. Earlier changes are not known.
+    op.execute(
+        """
+        INSERT INTO workflow_transition
+            (id, package_id, owner_org, from_status, to_status, timestamp)
+        SELECT
+            'backfill-' || package.id,
+            package.id,
+            package.owner_org,
+            NULL,
+            package_extra.value,
+            COALESCE(package.metadata_modified, package.metadata_created, NOW())
+        FROM package
+        JOIN package_extra ON package_extra.package_id = package.id
+        WHERE package_extra.key = 'workflow_status'
+            AND package_extra.value <> ''
+            AND package.state <> 'deleted'
+        """
+    )
+
+
+def downgrade():
+    op.drop_table("workflow_transition")
@@ -0,0 +1,154 @@
+"""Database tables of the workflow extension.
+
+The tables are created by the extension's migrations::
+
+    ckan db upgrade -p workflow
+"""
+from __future__ import annotations
+
+import datetime
+import logging
+from typing import Any, Optional
+
+from sqlalchemy import Column, DateTime, Index, UnicodeText, event, inspect
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.attributes import NEVER_SET, NO_VALUE
+
+import ckan.model as model
+import ckan.plugins.toolkit as tk
+from ckan.model.types import make_uuid
+
+log = logging.getLogger(__name__)
+
+# Session.info key of the workflow statuses packages had when the transaction began
+PREVIOUS_STATUS_KEY = "workflow_previous_status"
+
+
+class WorkflowNotification(tk.BaseModel):
+    """A notification waiting to be sent in the recipient's next digest email."""
+
+    __tablename__ = "workflow_notification"
+
+    id = Column(UnicodeText, primary_key=True, default=make_uuid)
+    recipient_email = Column(UnicodeText, nullable=False)
+    # The workflow status the dataset moved to
+    kind = Column(UnicodeText, nullable=False)
+    package_name = Column(UnicodeText, nullable=False)
+    url = Column(UnicodeText, nullable=False)
+    organization = Column(UnicodeText)
+    user_name = Column(UnicodeText)
+    notes = Column(UnicodeText)
+    created = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+
+class WorkflowTransition(tk.BaseModel):
+    """A change of a dataset's workflow status. Rows are never updated."""
+
+    __tablename__ = "workflow_transition"
+    __table_args__ = (
+        Index("idx_workflow_transition_package_timestamp", "package_id", "timestamp"),
+        Index(
+            "idx_workflow_transition_org_status_timestamp",
+            "owner_org",
+            "to_status",
+            "timestamp",
+        ),
+        Index("idx_workflow_transition_status_timestamp", "to_status", "timestamp"),
+    )
+
+    id = Column(UnicodeText, primary_key=True, default=make_uuid)
+    package_id = Column(UnicodeText, nullable=False)
+    owner_org = Column(UnicodeText)
+    from_status = Column(UnicodeText)
+    to_status = Column(UnicodeText)
+    user_id = Column(UnicodeText)
+    notes = Column(UnicodeText)
+    timestamp = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "package_id": self.package_id,
+            "owner_org": self.owner_org,
+            "from_status": self.from_status,
+            "to_status": self.to_status,
+            "user_id": self.user_id,
+            "notes": self.notes,
+            "timestamp": self.timestamp.isoformat(),
+        }
+
+
+_transition_table_exists = False
+
+
+def _has_transition_table() -> bool:
+    # Only a positive answer is kept, so that running the migration takes
+    # effect without restarting CKAN
+    global _transition_table_exists
+    if not _transition_table_exists:
+        _transition_table_exists = inspect(model.Session.get_bind()).has_table(
+            WorkflowTransition.__tablename__
+        )
+    return _transition_table_exists
+
+
+def record_transition(
+    package: model.Package,
+    from_status: Optional[str],
+    to_status: Optional[str],
+    user_id: Optional[str] = None,
+    notes: Optional[str] = None,
+):
+    """Add a transition to the session, it is committed with the package.
+
+    Nothing is recorded until the extension's migrations have run, so that
+    datasets can still be saved in the meantime.
+    """
+    if not _has_transition_table():
+        log.warning(
+            "Not recording the workflow transition of dataset %s: the %s table "
+            "does not exist, run `ckan db upgrade -p workflow`",
+            package.id,
+            WorkflowTransition.__tablename__,
+        )
+        return
+    model.Session.add(
+        WorkflowTransition(
+            package_id=package.id,
+            owner_org=package.owner_org,
+            from_status=from_status,
+            to_status=to_status,
+            user_id=user_id,
+            notes=notes,
+        )
+    )
+
+
+@event.listens_for(model.PackageExtra.value, "set", active_history=True)
+def _record_previous_status(target, value, oldvalue, initiator):
+    if target.key != "workflow_status" or not target.package_id:
+        return
+    session = object_session(target)
+    if session is None or oldvalue in (NO_VALUE, NEVER_SET):
+        return
+    # Only the first change in the transaction holds the stored status
+    session.info.setdefault(PREVIOUS_STATUS_KEY, {}).setdefault(
+        target.package_id, oldvalue
+    )
+
+
+@event.listens_for(model.Session, "after_commit")
+@event.listens_for(model.Session, "after_rollback")
+def _clear_previous_status(session):
+    session.info.pop(PREVIOUS_STATUS_KEY, None)
+
+
+def previous_workflow_status(package: model.Package) -> Optional[Any]:
+    """The workflow status the package had before the current transaction.
+
+    This avoids loading the previous version of the package from the activity
+    stream just to compare its workflow status.
+    """
+    changed = model.Session.info.get(PREVIOUS_STATUS_KEY, {})
+    if package.id in changed:
+        return changed[package.id]
+    return package.extras.get("workflow_status")
@@ -0,0 +1,223 @@
+"""Sending of workflow notification emails.
+
+Messages are rendered during the request and handed to a background job,
+which sends the whole batch over a single SMTP session set up from the site's
+``smtp.*`` settings. If the job queue cannot be reached, the batch is sent
+from a thread in the current process so that saving a dataset never waits on
+the mail server.
+
+When ``ckan.workflow.notification_digest_interval`` is set, notifications are
+queued in the ``workflow_notification`` table instead, and ``ckan workflow
+send-digests`` sends each recipient a single email listing everything queued
+for them once their oldest notification is older than the interval.
+"""
+from __future__ import annotations
+
+import datetime
+import logging
+import smtplib
+import threading
+from collections import defaultdict
+from email.message import EmailMessage
+from email.utils import formataddr, formatdate
+from typing import Iterable, NamedTuple, Optional
+
+from sqlalchemy import func
+
+import ckan
+import ckan.lib.mailer as mailer
+import ckan.model as model
+import ckan.plugins.toolkit as tk
+
+from ckanext.workflow.model import WorkflowNotification
+
+log = logging.getLogger(__name__)
+
+
+class Notification(NamedTuple):
+    recipient_email: str
+    subject: str
+    body: str
+
+
+def _build_message(notification: Notification, mail_from: str) -> EmailMessage:
+    # The same headers as ckan.lib.mailer
+    msg = EmailMessage()
+    msg.set_content(notification.body, charset="utf-8")
+    msg["Subject"] = notification.subject
+    msg["From"] = formataddr((tk.config.get("ckan.site_title"), mail_from))
+    msg["To"] = formataddr((notification.recipient_email, notification.recipient_email))
+    msg["Date"] = formatdate()
+    msg["X-Mailer"] = "CKAN %s" % ckan.__version__
+    reply_to = tk.config.get("smtp.reply_to")
+    if reply_to:
+        msg["Reply-to"] = reply_to
+    return msg
+
+
+def _connect() -> smtplib.SMTP:
+    """Open an SMTP session set up from the site's ``smtp.*`` settings, the
+    way ``ckan.lib.mailer`` sets up the session of each email it sends."""
+    test_server = tk.config.get("smtp.test_server")
+    if test_server:
+        return smtplib.SMTP(test_server)
+
+    connection = smtplib.SMTP(tk.config.get("smtp.server") or "localhost")
+    connection.ehlo()
+    if tk.asbool(tk.config.get("smtp.starttls")):
+        if not connection.has_extn("STARTTLS"):
+            raise mailer.MailerException("SMTP server does not support STARTTLS")
+        connection.starttls()
+        connection.ehlo()
+
+    user = tk.config.get("smtp.user")
+    if user:
+        connection.login(user, tk.config.get("smtp.password"))
+    return connection
+
+
+def send_notifications(notifications: Iterable[Notification]) -> list[Notification]:
+    """Send the notifications over a single SMTP session.
+
+    Returns the notifications that could not be sent.
+    """
+    notifications = [n for n in notifications if n.recipient_email]
+    if not notifications:
+        return []
+
+    mail_from = tk.config.get("smtp.mail_from")
+    try:
+        connection = _connect()
+    except (mailer.MailerException, smtplib.SMTPException, OSError):
+        log.error(
+            "Cannot connect to the mail server to send %d workflow notifications",
+            len(notifications),
+            exc_info=True,
+        )
+        return notifications
+
+    failed = []
+    try:
+        for notification in notifications:
+            try:
+                connection.sendmail(
+                    mail_from,
+                    [notification.recipient_email],
+                    _build_message(notification, mail_from).as_string(),
+                )
+            except smtplib.SMTPException:
+                failed.append(notification)
+                log.error(
+                    "Cannot send workflow status notification email to %s.",
+                    notification.recipient_email,
+                    exc_info=True,
+                )
+    finally:
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+
+    return failed
+
+
+def dispatch(notifications: Iterable[Notification]):
+    """Send the notifications without holding up the current request."""
+    notifications = list(notifications)
+    if not notifications:
+        return
+
+    if not tk.asbool(tk.config.get("ckan.workflow.notifications_async", True)):
+        send_notifications(notifications)
+        return
+
+    try:
+        tk.enqueue_job(
+            send_notifications,
+            [notifications],
+            title="Workflow notifications",
+        )
+    except Exception:
+        log.warning(
+            "Cannot enqueue workflow notifications, sending them in-process",
+            exc_info=True,
+        )
+        threading.Thread(
+            target=send_notifications, args=(notifications,), daemon=True
+        ).start()
+
+
+def digest_interval() -> int:
+    """Seconds notifications are held for the digest, 0 when digests are off."""
+    return tk.asint(tk.config.get("ckan.workflow.notification_digest_interval", 0))
+
+
+def queue_digest(
+    recipients: Iterable[str],
+    kind: str,
+    package_name: str,
+    url: str,
+    organization: Optional[str] = None,
+    user_name: Optional[str] = None,
+    notes: Optional[str] = None,
+):
+    """Queue a notification for the next digest of each recipient.
+
+    The rows are committed along with the dataset change that caused them.
+    """
+    for recipient in recipients:
+        if recipient:
+            model.Session.add(
+                WorkflowNotification(
+                    recipient_email=recipient,
+                    kind=kind,
+                    package_name=package_name,
+                    url=url,
+                    organization=organization,
+                    user_name=user_name,
+                    notes=notes,
+                )
+            )
+
+
+def send_digests(force: bool = False) -> int:
+    """Send the digests that are due, returns the number of emails sent.
+
+    Must be called with a request context, to render the email template.
+    """
+    query = model.Session.query(WorkflowNotification).order_by(
+        WorkflowNotification.created
+    )
+    if not force:
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=digest_interval()
+        )
+        due = (
+            model.Session.query(WorkflowNotification.recipient_email)
+            .group_by(WorkflowNotification.recipient_email)
+            .having(func.min(WorkflowNotification.created) <= cutoff)
+        )
+        query = query.filter(WorkflowNotification.recipient_email.in_(due))
+
+    queued = defaultdict(list)
+    for item in query:
+        queued[item.recipient_email].append(item)
+
+    digests = [
+        Notification(
+            recipient,
+            f"Workflow status changes ({len(items)})",
+            tk.render("email/notification-digest.txt", extra_vars={"items": items}),
+        )
+        for recipient, items in queued.items()
+    ]
+    failed = {n.recipient_email for n in send_notifications(digests)}
+
+    # Anything that could not be sent stays queued for the next run
+    for recipient, items in queued.items():
+        if recipient not in failed:
+            for item in items:
+                model.Session.delete(item)
+    model.Session.commit()
+
+    return len(digests) - len(failed)
@@ -0,0 +1,54 @@
+"""Parsing of the Solr parameters of dataset searches.
+
+This module does not import CKAN, so it can be tested and benchmarked on its
+own.
+"""
+from __future__ import annotations
+
+import functools
+import re
+
+# owner_org:"id", owner_org:id or owner_org:("id" OR id ...), optionally
+# prefixed by + or -, but not as the end of another field name
+_OWNER_ORG = re.compile(
+    r"""(?<![\w.])(?P<sign>[+-]?)owner_org:\s*
+        (?:
+            "(?P<quoted>[^"]*)"
+          | \((?P<group>[^)]*)\)
+          | (?P<bare>[^\s()"]+)
+        )""",
+    re.VERBOSE,
+)
+_GROUP_VALUE = re.compile(r'"([^"]*)"|([^\s"()]+)')
+_OPERATORS = frozenset(["AND", "OR", "NOT", "&&", "||", "+", "-"])
+
+
+@functools.lru_cache(maxsize=512)
+def _owner_orgs(param: str) -> tuple[str, ...]:
+    organization_ids = []
+    for match in _OWNER_ORG.finditer(param):
+        # Negated organisations are excluded from the search, not searched
+        if match.group("sign") == "-":
+            continue
+        if match.group("group") is not None:
+            for quoted, bare in _GROUP_VALUE.findall(match.group("group")):
+                value = quoted or bare.lstrip("+")
+                if value and bare not in _OPERATORS:
+                    organization_ids.append(value)
+        else:
+            organization_ids.append(match.group("quoted") or match.group("bare"))
+    return tuple(organization_ids)
+
+
+def owner_orgs(*params: str | None) -> tuple[str, ...]:
+    """The organisations a search is restricted to by ``owner_org`` clauses
+    in any of the parameters (e.g. ``fq`` and ``q``), in order, without
+    duplicates. Never raises for malformed parameters, it just finds less.
+    """
+    found: dict[str, None] = {}
+    for param in params:
+        if param and "owner_org" in param:
+            found.update(dict.fromkeys(_owner_orgs(param)))
+    found.pop("", None)
+    found.pop("*", None)
+    return tuple(found)
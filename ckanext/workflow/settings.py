@@ -0,0 +1,270 @@
+"""Cached access to the workflow settings file (``ckan.workflow.json_config``).
+
+The file is parsed and validated once, when the plugin is configured, and is
+only read again when its inode or modification time changes, or when
+``settings_reload`` is sent.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+from types import MappingProxyType
+from typing import Any, Mapping, Optional
+
+import ckan.plugins.toolkit as tk
+from ckan.exceptions import CkanConfigurationException
+
+log = logging.getLogger(__name__)
+
+CONFIG_PATH = "ckan.workflow.json_config"
+DEFAULT_PATH = "/app/ckan/default/workflow.settings.json"
+
+# Status used when a dataset has no (or an unknown) workflow status
+DEFAULT_STATUS = "draft"
+
+# The fallbacks of settings files that have no "fallbacks", as the transition
+# rules used to be hard-coded: a disallowed request from draft asks for approval
+LEGACY_FALLBACKS = {DEFAULT_STATUS: "ready_for_approval"}
+
+# Send this signal to force the settings file to be read again
+settings_reload = tk.signals.ckanext.signal("workflow_settings_reload")
+
+
+class WorkflowSettings:
+    """Validated, read-only view of the workflow settings.
+
+    ``workflows`` maps each status to the statuses it can move to, and
+    ``role_options`` maps each role to the statuses it may select. Both hold
+    frozensets, and the statuses available to every (status, role) pair are
+    computed up front so that lookups do not allocate.
+
+    ``transitions`` maps (role, from_status, requested_status) to the status
+    a dataset actually ends up in. A requested status the role may not move
+    to is replaced by the ``fallbacks`` entry for the current status when the
+    role is allowed to use it, otherwise by the role's
+    ``default_workflow_status``. Settings without ``fallbacks`` get
+    ``LEGACY_FALLBACKS``.
+    """
+
+    def __init__(self, data: dict[str, Any]):
+        _validate(data)
+        self.data = data
+
+        self.workflows: Mapping[str, frozenset[str]] = MappingProxyType(
+            {
+                status: frozenset(targets)
+                for status, targets in data["workflows"].items()
+            }
+        )
+        self.role_options: Mapping[str, frozenset[str]] = MappingProxyType(
+            {
+                role: frozenset(options.get("workflow_status_options", []))
+                for role, options in data["roles"].items()
+            }
+        )
+        self.statuses = frozenset(self.workflows)
+
+        # Users without a known role may only keep datasets in draft
+        no_role_options = frozenset([DEFAULT_STATUS])
+        self._available = {
+            (status, role): targets & self.role_options.get(role, no_role_options)
+            for status, targets in self.workflows.items()
+            for role in [None, *self.role_options]
+        }
+
+        fallbacks = _fallbacks(data)
+        self.transitions: dict[tuple[Optional[str], str, str], str] = {}
+        self._fallbacks: dict[tuple[Optional[str], str], str] = {}
+        for (status, role), allowed in self._available.items():
+            fallback = fallbacks.get(status)
+            if fallback not in allowed:
+                fallback = data["roles"].get(role, {}).get(
+                    "default_workflow_status", DEFAULT_STATUS
+                )
+            self._fallbacks[(role, status)] = fallback
+            for requested in self.statuses:
+                self.transitions[(role, status, requested)] = (
+                    requested if requested in allowed else fallback
+                )
+
+    def status_options(self, current_status: Optional[str]) -> frozenset[str]:
+        """Statuses reachable from ``current_status`` regardless of role."""
+        if current_status in self.workflows:
+            return self.workflows[current_status]
+        return self.workflows[DEFAULT_STATUS]
+
+    def available_statuses(
+        self, current_status: Optional[str], role: Optional[str]
+    ) -> frozenset[str]:
+        """Statuses a user with ``role`` may select from ``current_status``."""
+        if current_status not in self.workflows:
+            current_status = DEFAULT_STATUS
+        if role not in self.role_options:
+            role = None
+        return self._available[(current_status, role)]
+
+    def resolve_transition(
+        self,
+        role: Optional[str],
+        current_status: Optional[str],
+        requested_status: Optional[str],
+    ) -> str:
+        """Status a user with ``role`` ends up with when requesting a change."""
+        if current_status not in self.workflows:
+            current_status = DEFAULT_STATUS
+        if role not in self.role_options:
+            role = None
+        try:
+            return self.transitions[(role, current_status, requested_status)]
+        except KeyError:
+            return self._fallbacks[(role, current_status)]
+
+
+def _fallbacks(data: dict[str, Any]) -> dict[str, str]:
+    if "fallbacks" in data:
+        return data["fallbacks"]
+    return {
+        status: fallback
+        for status, fallback in LEGACY_FALLBACKS.items()
+        if status in data["workflows"] and fallback in data["workflows"]
+    }
+
+
+def _validate(data: Any):
+    if not isinstance(data, dict):
+        raise CkanConfigurationException(
+            "Workflow settings must be a JSON object"
+        )
+
+    workflows = data.get("workflows")
+    if not isinstance(workflows, dict) or DEFAULT_STATUS not in workflows:
+        raise CkanConfigurationException(
+            f'Workflow settings must define "workflows", including "{DEFAULT_STATUS}"'
+        )
+    for status, targets in workflows.items():
+        if not isinstance(targets, list):
+            raise CkanConfigurationException(
+                f'Workflow "{status}" must be a list of statuses'
+            )
+        unknown = set(targets) - set(workflows)
+        if unknown:
+            raise CkanConfigurationException(
+                f'Workflow "{status}" refers to undefined statuses: {sorted(unknown)}'
+            )
+
+    roles = data.get("roles")
+    if not isinstance(roles, dict):
+        raise CkanConfigurationException('Workflow settings must define "roles"')
+    for role, options in roles.items():
+        if not isinstance(options, dict):
+            raise CkanConfigurationException(f'Role "{role}" must be an object')
+        unknown = set(options.get("workflow_status_options", [])) - set(workflows)
+        default = options.get("default_workflow_status")
+        if default is not None and default not in workflows:
+            unknown.add(default)
+        if unknown:
+            raise CkanConfigurationException(
+                f'Role "{role}" refers to undefined statuses: {sorted(unknown)}'
+            )
+
+    fallbacks = data.get("fallbacks", {})
+    if not isinstance(fallbacks, dict):
+        raise CkanConfigurationException('"fallbacks" must be an object')
+    unknown = (set(fallbacks) | set(fallbacks.values())) - set(workflows)
+    if unknown:
+        raise CkanConfigurationException(
+            f'"fallbacks" refers to undefined statuses: {sorted(unknown)}'
+        )
+
+    # Every status has to be reachable from a status datasets start in...
+    initial = {DEFAULT_STATUS} | {
+        options["default_workflow_status"]
+        for options in roles.values()
+        if options.get("default_workflow_status")
+    }
+    reachable = set()
+    pending = list(initial)
+    while pending:
+        status = pending.pop()
+        if status not in reachable:
+            reachable.add(status)
+            pending.extend(workflows[status])
+    unreachable = set(workflows) - reachable
+    if unreachable:
+        raise CkanConfigurationException(
+            f"Workflow statuses cannot be reached: {sorted(unreachable)}"
+        )
+
+    # ...and datasets must be able to leave every status
+    dead = [status for status, targets in workflows.items() if not set(targets) - {status}]
+    if dead:
+        raise CkanConfigurationException(
+            f"Workflow statuses have no way out: {sorted(dead)}"
+        )
+
+
+class _SettingsCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._settings: Optional[WorkflowSettings] = None
+        self._path: Optional[str] = None
+        self._stamp: Optional[tuple[int, int]] = None
+
+    def get(self) -> WorkflowSettings:
+        path = tk.config.get(CONFIG_PATH, DEFAULT_PATH)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            if self._settings is not None and path == self._path:
+                log.warning("Workflow settings file %s is missing, using cached copy", path)
+                return self._settings
+            raise
+
+        stamp = (stat.st_ino, stat.st_mtime_ns)
+        if self._settings is None or path != self._path or stamp != self._stamp:
+            self.load(path, stamp)
+        return self._settings
+
+    def load(self, path: Optional[str] = None, stamp: Optional[tuple[int, int]] = None):
+        path = path or tk.config.get(CONFIG_PATH, DEFAULT_PATH)
+        with self._lock:
+            if stamp is None:
+                stat = os.stat(path)
+                stamp = (stat.st_ino, stat.st_mtime_ns)
+            elif self._settings is not None and (path, stamp) == (self._path, self._stamp):
+                # Another thread already reloaded it
+                return
+
+            try:
+                with open(path) as json_data:
+                    settings = WorkflowSettings(json.load(json_data))
+            except (ValueError, CkanConfigurationException):
+                # Keep serving the last good copy if the file is edited in place
+                if self._settings is None or path != self._path:
+                    raise
+                log.error("Invalid workflow settings in %s, keeping previous settings", path, exc_info=True)
+                settings = self._settings
+
+            self._settings, self._path, self._stamp = settings, path, stamp
+            log.debug("Loaded workflow settings from %s", path)
+
+
+_cache = _SettingsCache()
+
+
+def get_settings() -> WorkflowSettings:
+    """Return the current workflow settings, reloading them if the file changed."""
+    return _cache.get()
+
+
+def load_settings() -> WorkflowSettings:
+    """Read and validate the settings file, raising on any error."""
+    _cache.load()
+    return _cache.get()
+
+
+@settings_reload.connect
+def reload_settings(sender: Any = None, **kwargs: Any):
+    _cache.load()
@@ -0,0 +1,81 @@
+"""Signal receivers keeping the workflow caches in step with the database."""
+from __future__ import annotations
+
+from typing import Any
+
+import ckan.model as model
+import ckan.plugins.toolkit as tk
+import ckan.types as types
+
+from ckanext.workflow import hierarchy
+from ckanext.workflow.logic import visibility
+
+
+def get_subscriptions() -> types.SignalMapping:
+    return {
+        tk.signals.action_succeeded: [
+            {"sender": "organization_create", "receiver": organization_changed},
+            {"sender": "organization_update", "receiver": organization_changed},
+            {"sender": "organization_delete", "receiver": organization_removed},
+            {"sender": "organization_purge", "receiver": organization_removed},
+            {"sender": "member_create", "receiver": member_changed},
+            {"sender": "member_delete", "receiver": member_changed},
+        ]
+    }
+
+
+def _organization_id(result: Any, data_dict: dict[str, Any]) -> Any:
+    if isinstance(result, dict) and result.get("id"):
+        return result["id"]
+    if isinstance(result, str):
+        return result
+    return data_dict.get("id")
+
+
+def organization_changed(sender: str, **kwargs: Any):
+    organization_id = _organization_id(
+        kwargs.get("result"), kwargs.get("data_dict") or {}
+    )
+    # The organisation may have been created or renamed
+    hierarchy.invalidate_names()
+    if organization_id:
+        hierarchy_changed(hierarchy.refresh_organization(organization_id))
+
+
+def organization_removed(sender: str, **kwargs: Any):
+    organization_id = _removed_organization_id(
+        kwargs.get("result"), kwargs.get("data_dict") or {}
+    )
+    # Removing an organisation also removes its place in the hierarchy, so the
+    # datasets of the tree it was in are related to different organisations
+    before = hierarchy.loaded_hierarchy() or hierarchy.get_hierarchy()
+    hierarchy.invalidate()
+    hierarchy.invalidate_names()
+    if organization_id:
+        hierarchy_changed(before.tree(organization_id) - {organization_id})
+
+
+def _removed_organization_id(result: Any, data_dict: dict[str, Any]) -> Any:
+    organization = _organization_id(result, data_dict)
+    if not organization:
+        return None
+    # Deleted organisations are still in the database, purged ones may still
+    # be in the cached summaries
+    group = model.Group.get(organization)
+    if group is not None:
+        return group.id
+    summary = hierarchy.get_organization_summary(organization)
+    return summary.id if summary else organization
+
+
+def member_changed(sender: str, **kwargs: Any):
+    data_dict = kwargs.get("data_dict") or {}
+    # Organisations are members of their parent organisation
+    if data_dict.get("object_type") == "group" and data_dict.get("object"):
+        hierarchy_changed(hierarchy.refresh_organization(data_dict["object"]))
+
+
+def hierarchy_changed(organization_ids: frozenset[str]):
+    # Indexed visibility of the datasets in these organisations is now stale
+    if organization_ids and visibility.is_enabled():
+        visibility.enqueue_reindex(organization_ids)
@@ -0,0 +1,17 @@
+"""The benchmarks run against the CKAN test database configured in test.ini.
+
+None of the measured code sends anything to Solr, so no search server is
+needed. Besides wall time, each benchmark stores in its ``extra_info`` the
+number of SQL statements one cold call issues and, for the search filters,
+the length of the generated fq. Use ``--benchmark-json`` to keep them.
+"""
+import pytest
+
+from ckanext.workflow.tests.benchmarks.synthetic import reset_caches
+
+
+@pytest.fixture(autouse=True)
+def _reset_workflow_caches():
+    reset_caches()
+    yield
+    reset_caches()
@@ -0,0 +1,141 @@
+"""Synthetic organisation trees and measurements shared by the benchmarks."""
+import contextlib
+from typing import NamedTuple
+
+from sqlalchemy import event
+
+import ckan.model as model
+
+from ckanext.workflow import hierarchy
+from ckanext.workflow.logic import auth, queries
+
+
+class OrganizationTree(NamedTuple):
+    root_id: str
+    # Organisation ids of each level of the tree, the root level first
+    levels: list
+
+    @property
+    def size(self):
+        return sum(len(level) for level in self.levels)
+
+
+def tree_edges(depth, breadth, prefix="org"):
+    """The (child, parent) name pairs of a tree of ``breadth`` children per
+    organisation, ``depth`` levels below the root named ``prefix``, and the
+    names of each level. Children are named after their parent, e.g. ``org-0-1``.
+    """
+    edges = []
+    levels = [[prefix]]
+    for _ in range(depth):
+        level = []
+        for parent in levels[-1]:
+            for index in range(breadth):
+                child = f"{parent}-{index}"
+                edges.append((child, parent))
+                level.append(child)
+        levels.append(level)
+    return edges, levels
+
+
+def make_hierarchy(depth, breadth, prefix="org"):
+    """The tree of ``tree_edges`` as an in-memory hierarchy index, with the
+    organisation names as ids. Returns the index and the tree."""
+    edges, levels = tree_edges(depth, breadth, prefix)
+    index = hierarchy.OrganizationHierarchy(
+        edges, [name for level in levels for name in level]
+    )
+    return index, OrganizationTree(prefix, levels)
+
+
+def make_organization_tree(depth, breadth, prefix="org"):
+    """Create the organisations of the tree of ``tree_edges``."""
+    edges, levels = tree_edges(depth, breadth, prefix)
+    groups = {}
+    for level in levels:
+        for name in level:
+            groups[name] = model.Group(
+                name=name, title=name, type="organization", is_organization=True
+            )
+            model.Session.add(groups[name])
+    model.Session.flush()
+
+    for child, parent in edges:
+        model.Session.add(
+            model.Member(
+                group_id=groups[parent].id,
+                table_id=groups[child].id,
+                table_name="group",
+                capacity="parent",
+            )
+        )
+
+    model.Session.commit()
+    return OrganizationTree(
+        groups[prefix].id, [[groups[name].id for name in level] for level in levels]
+    )
+
+
+def make_user(name, memberships):
+    """Create a user with the given {organisation id: capacity} memberships."""
+    user = model.User(name=name, email=f"{name}@example.com", password="password")
+    model.Session.add(user)
+    model.Session.flush()
+    for organization_id, capacity in memberships.items():
+        model.Session.add(
+            model.Member(
+                group_id=organization_id,
+                table_id=user.id,
+                table_name="user",
+                capacity=capacity,
+            )
+        )
+    model.Session.commit()
+    return user
+
+
+def make_dataset(name, owner_org, **extras):
+    package = model.Package(name=name, owner_org=owner_org, private=True)
+    model.Session.add(package)
+    model.Session.flush()
+    for key, value in extras.items():
+        package.extras[key] = value
+    model.Session.commit()
+    return package
+
+
+def reset_caches():
+    """Forget everything the workflow caches know, for cold measurements."""
+    hierarchy.invalidate()
+    hierarchy.invalidate_names()
+    queries.filter_cache.clear()
+    queries.organization_filter_cache.clear()
+    auth.decision_cache.clear()
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+
+
+@contextlib.contextmanager
+def count_queries():
+    """Count the SQL statements issued inside the block."""
+    counter = QueryCounter()
+    engine = model.Session.get_bind()
+    event.listen(engine, "before_cursor_execute", counter)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, "before_cursor_execute", counter)
+
+
+def cold_queries(func, *args):
+    """Number of SQL statements a call issues with empty caches."""
+    reset_caches()
+    with count_queries() as counter:
+        func(*args)
+    return counter.count
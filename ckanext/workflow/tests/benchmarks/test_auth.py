@@ -0,0 +1,90 @@
+"""How the package_show auth function and the family check scale with the
+organisation hierarchy."""
+import pytest
+
+import ckan.authz as authz
+
+from ckanext.workflow import helpers
+from ckanext.workflow.tests.benchmarks.synthetic import (
+    cold_queries,
+    make_dataset,
+    make_organization_tree,
+    make_user,
+    reset_caches,
+)
+
+# (depth, breadth)
+TREES = [(2, 5), (4, 5), (6, 2), (2, 25)]
+
+# Statements a cold check may issue whatever the hierarchy size: the dataset
+# and its extras, the user, their memberships and the hierarchy index
+MAX_QUERIES = 8
+
+
+def _tree_id(tree):
+    return "depth{0}-breadth{1}".format(*tree)
+
+
+def _family_dataset(depth, breadth):
+    """A user in the first leaf and a dataset of the last leaf, visible to
+    the user through its family organisation visibility."""
+    tree = make_organization_tree(depth, breadth)
+    user = make_user("benchmark-user", {tree.levels[-1][0]: "member"})
+    package = make_dataset(
+        "benchmark-dataset",
+        tree.levels[-1][-1],
+        workflow_status="published",
+        organization_visibility="family",
+    )
+    return tree, user, package
+
+
+def _package_show_allowed(user_name, package_id):
+    return authz.is_authorized(
+        "package_show", {"user": user_name}, {"id": package_id}
+    )["success"]
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+@pytest.mark.ckan_config("ckan.plugins", "workflow")
+@pytest.mark.parametrize("tree_shape", TREES, ids=_tree_id)
+class TestAuth:
+    def test_package_show_cold(self, benchmark, tree_shape):
+        tree, user, package = _family_dataset(*tree_shape)
+
+        queries_issued = cold_queries(_package_show_allowed, user.name, package.id)
+        allowed = benchmark.pedantic(
+            _package_show_allowed,
+            (user.name, package.id),
+            setup=reset_caches,
+            rounds=20,
+        )
+
+        benchmark.group = "package_show auth cold"
+        benchmark.extra_info.update(organizations=tree.size, queries=queries_issued)
+        assert allowed
+        assert queries_issued <= MAX_QUERIES
+
+    def test_package_show_cached(self, benchmark, tree_shape):
+        tree, user, package = _family_dataset(*tree_shape)
+
+        assert _package_show_allowed(user.name, package.id)
+        allowed = benchmark(_package_show_allowed, user.name, package.id)
+
+        benchmark.group = "package_show auth cached"
+        benchmark.extra_info.update(organizations=tree.size)
+        assert allowed
+
+    def test_is_user_in_family_organization(self, benchmark, tree_shape):
+        tree, user, package = _family_dataset(*tree_shape)
+        user_organization_ids = helpers.get_user_organization_ids(user.name)
+
+        in_family = benchmark(
+            helpers.is_user_in_family_organization,
+            package.owner_org,
+            user_organization_ids,
+        )
+
+        benchmark.group = "is_user_in_family_organization"
+        benchmark.extra_info.update(organizations=tree.size)
+        assert in_family
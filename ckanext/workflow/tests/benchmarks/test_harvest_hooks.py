@@ -0,0 +1,63 @@
+"""Per-dataset cost of the IPackageController hooks for harvested datasets.
+
+Run with::
+
+    pytest --ckan-ini=test.ini ckanext/workflow/tests/benchmarks
+"""
+import pytest
+
+import ckan.model as model
+import ckan.plugins as plugins
+
+from ckanext.workflow import harvest
+
+
+def _create(plugin):
+    plugin.create(model.Package(name="harvested", private=True))
+
+
+@pytest.fixture
+def plugin():
+    yield plugins.get_plugin("workflow")
+    # Discard the workflow transitions added by the hooks
+    model.Session.rollback()
+
+
+@pytest.mark.ckan_config("ckan.plugins", "workflow")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+class TestHarvestHooks:
+    def test_create_outside_request(self, benchmark, plugin):
+        benchmark(_create, plugin)
+
+    def test_create_in_harvest_mode(self, benchmark, plugin):
+        with harvest.harvest_mode():
+            benchmark(_create, plugin)
+
+    def test_create_in_harvest_mode_within_request(self, benchmark, plugin, app):
+        with app.flask_app.test_request_context("/api/action/package_create"):
+            with harvest.harvest_mode():
+                benchmark(_create, plugin)
+
+    def test_apply_defaults(self, benchmark):
+        benchmark(lambda: harvest.apply_defaults({}, True))
+
+    def test_defaults(self):
+        extras = {}
+        harvest.apply_defaults(extras, True)
+        assert extras == {
+            "workflow_status": "draft",
+            "organization_visibility": "current",
+        }
+
+        extras = {"workflow_status": "ready_for_approval"}
+        harvest.apply_defaults(extras, False)
+        assert extras == {
+            "workflow_status": "ready_for_approval",
+            "organization_visibility": "all",
+        }
+
+    def test_harvest_mode_skips_request(self, app):
+        with app.flask_app.test_request_context("/dataset/new"):
+            with harvest.harvest_mode():
+                assert not harvest.is_dataset_form_save()
+        assert not harvest.is_harvest_mode()
@@ -0,0 +1,51 @@
+"""Cost of the organisation relationship helpers as users join more organisations.
+
+The helpers match id sets, so their cost should grow linearly with the number
+of the user's organisations rather than with its product with the hierarchy
+size. Compare the ``mean`` column across the ``user_organizations`` values::
+
+    pytest --ckan-ini=test.ini ckanext/workflow/tests/benchmarks/test_hierarchy_helpers.py
+"""
+import pytest
+
+from ckanext.workflow import helpers, hierarchy
+from ckanext.workflow.tests.benchmarks.synthetic import make_hierarchy
+
+BREADTH = 5
+DEPTH = 5
+
+
+@pytest.fixture(scope="module")
+def tree():
+    return make_hierarchy(DEPTH, BREADTH)
+
+
+@pytest.fixture
+def leaves(tree, monkeypatch):
+    index, organization_tree = tree
+    monkeypatch.setattr(hierarchy, "get_hierarchy", lambda: index)
+    return organization_tree.levels[-1]
+
+
+def _user_organization_ids(count):
+    # Organisations unrelated to the dataset's, so every check runs to the end
+    return frozenset(f"unrelated-{number}" for number in range(count))
+
+
+@pytest.mark.parametrize("user_organizations", [10, 100, 1000])
+@pytest.mark.parametrize("relationship", ["parent", "child", "family"])
+def test_has_relationship(benchmark, leaves, relationship, user_organizations):
+    benchmark.group = f"has_relationship {relationship}"
+    user_organization_ids = _user_organization_ids(user_organizations)
+
+    assert not benchmark(
+        helpers.has_relationship, leaves[0], user_organization_ids, relationship
+    )
+
+
+@pytest.mark.parametrize("user_organizations", [10, 100, 1000])
+def test_find_match_in_list(benchmark, leaves, user_organizations):
+    benchmark.group = "find_match_in_list"
+    user_organization_ids = _user_organization_ids(user_organizations)
+
+    assert not benchmark(helpers.find_match_in_list, leaves, user_organization_ids)
@@ -0,0 +1,30 @@
+"""Cost of extracting owner_org from the search parameters of the
+organisation read page."""
+import pytest
+
+from ckanext.workflow import search_params
+
+FQS = {
+    "organization_read": ' owner_org:"5b1f2d6e-3c5a-4b8e-9d2f-0a1b2c3d4e5f" +dataset_type:dataset',
+    "faceted": (
+        ' owner_org:"5b1f2d6e-3c5a-4b8e-9d2f-0a1b2c3d4e5f" tags:"water quality"'
+        ' res_format:"CSV" groups:"environment" +dataset_type:dataset'
+    ),
+    "several_organizations": "owner_org:({0})".format(
+        " OR ".join(f'"org-{number:04d}"' for number in range(50))
+    ),
+    "no_organization": 'tags:"water quality" res_format:"CSV" +dataset_type:dataset',
+}
+
+
+@pytest.mark.parametrize("fq", FQS.values(), ids=FQS.keys())
+def test_parse(benchmark, fq):
+    benchmark.group = "owner_org parse"
+    # Bypass the parse cache to measure the regular expressions
+    benchmark(search_params._owner_orgs.__wrapped__, fq)
+
+
+@pytest.mark.parametrize("fq", FQS.values(), ids=FQS.keys())
+def test_owner_orgs(benchmark, fq):
+    benchmark.group = "owner_orgs"
+    benchmark(search_params.owner_orgs, fq, "")
@@ -0,0 +1,97 @@
+"""How the dataset search filters scale with the organisation hierarchy.
+
+Scenarios vary the depth and breadth of the tree and the number of
+organisations the user belongs to. As a regression gate, the number of SQL
+statements must not grow with any of them, and runs can be compared with
+``--benchmark-autosave`` and ``--benchmark-compare-fail=mean:20%``.
+"""
+import pytest
+
+import ckan.model as model
+
+from ckanext.workflow.logic import queries
+from ckanext.workflow.tests.benchmarks.synthetic import (
+    cold_queries,
+    make_organization_tree,
+    make_user,
+)
+
+# (depth, breadth, memberships)
+SCENARIOS = [
+    (2, 5, 1),
+    (3, 5, 10),
+    (4, 5, 50),
+    (2, 25, 50),
+    (6, 2, 50),
+]
+
+# Statements a cold call may issue whatever the hierarchy size: loading the
+# hierarchy index, the user's memberships and the user's collaborations
+MAX_QUERIES = 6
+
+
+def _scenario_id(scenario):
+    return "depth{0}-breadth{1}-member{2}".format(*scenario)
+
+
+def _user(tree, memberships):
+    # Spread the memberships over the deepest level, with a mix of roles
+    leaves = tree.levels[-1]
+    step = max(len(leaves) // memberships, 1)
+    capacities = ["admin", "editor", "member"]
+    return make_user(
+        "benchmark-user",
+        {
+            organization_id: capacities[index % len(capacities)]
+            for index, organization_id in enumerate(leaves[::step][:memberships])
+        },
+    )
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+@pytest.mark.ckan_config("ckan.plugins", "workflow")
+@pytest.mark.parametrize("scenario", SCENARIOS, ids=_scenario_id)
+class TestSearchFilters:
+    def test_package_search_filter_query(self, benchmark, scenario):
+        depth, breadth, memberships = scenario
+        tree = make_organization_tree(depth, breadth)
+        user = _user(tree, memberships)
+
+        queries_issued = cold_queries(queries.package_search_filter_query, user)
+        fq = benchmark(queries.package_search_filter_query, user)
+
+        benchmark.group = "package_search_filter_query"
+        benchmark.extra_info.update(
+            organizations=tree.size, queries=queries_issued, fq_length=len(fq)
+        )
+        assert queries_issued <= MAX_QUERIES
+
+    def test_organization_read_filter_query(self, benchmark, scenario):
+        depth, breadth, memberships = scenario
+        tree = make_organization_tree(depth, breadth)
+        user = _user(tree, memberships)
+        # A sibling of the user's first organisation, which they are not a member of
+        organization_id = tree.levels[-1][1]
+
+        queries_issued = cold_queries(
+            queries.organization_read_filter_query, organization_id, user
+        )
+        fq = benchmark(queries.organization_read_filter_query, organization_id, user)
+
+        benchmark.group = "organization_read_filter_query"
+        benchmark.extra_info.update(
+            organizations=tree.size, queries=queries_issued, fq_length=len(fq)
+        )
+        assert queries_issued <= MAX_QUERIES
+
+    def test_package_search_filter_query_sysadmin(self, benchmark, scenario):
+        depth, breadth, memberships = scenario
+        tree = make_organization_tree(depth, breadth)
+        user = _user(tree, memberships)
+        user.sysadmin = True
+        model.Session.commit()
+
+        fq = benchmark(queries.package_search_filter_query, user)
+
+        benchmark.group = "package_search_filter_query sysadmin"
+        benchmark.extra_info.update(organizations=tree.size, fq_length=len(fq))
@@ -0,0 +1,192 @@
+import pytest
+
+import ckan.lib.search as search
+import ckan.model as model
+import ckan.plugins.toolkit as tk
+from ckan.tests import helpers as test_helpers
+
+from ckanext.workflow import notifications
+from ckanext.workflow.logic import action
+from ckanext.workflow.model import WorkflowNotification
+from ckanext.workflow.tests.benchmarks.synthetic import (
+    make_dataset,
+    make_organization_tree,
+    make_user,
+)
+
+
+@pytest.fixture
+def organization():
+    return make_organization_tree(0, 0).root_id
+
+
+@pytest.fixture
+def users(organization):
+    return {
+        capacity: make_user(capacity, {organization: capacity})
+        for capacity in ["admin", "editor", "member"]
+    }
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    sent = []
+    monkeypatch.setattr(
+        notifications, "dispatch", lambda batch: sent.extend(list(batch))
+    )
+    return sent
+
+
+def _transition(user_name, **data_dict):
+    return test_helpers.call_action(
+        "workflow_bulk_transition", context={"user": user_name}, **data_dict
+    )
+
+
+def _status(package_id):
+    package = model.Package.get(package_id)
+    return package.extras.get("workflow_status"), package.private
+
+
+@pytest.mark.ckan_config("ckan.plugins", "workflow")
+@pytest.mark.usefixtures("with_plugins", "clean_db", "clean_index", "with_request_context")
+class TestBulkTransition:
+    @pytest.mark.parametrize(
+        "role, from_status, to_status, allowed",
+        [
+            ("editor", "draft", "ready_for_approval", True),
+            ("editor", "ready_for_approval", "published", False),
+            ("editor", "published", "archived", True),
+            ("admin", "ready_for_approval", "published", True),
+            ("admin", "draft", "published", False),
+            ("admin", "archived", "published", False),
+        ],
+    )
+    def test_transitions_by_role(
+        self, organization, users, sent, role, from_status, to_status, allowed
+    ):
+        dataset = make_dataset("dataset", organization, workflow_status=from_status)
+
+        result = _transition(users[role].name, ids=[dataset.id], workflow_status=to_status)
+
+        if allowed:
+            assert result == {"updated": [dataset.id], "errors": {}}
+            assert _status(dataset.id)[0] == to_status
+        else:
+            assert result["updated"] == []
+            assert list(result["errors"]) == [dataset.id]
+            assert _status(dataset.id)[0] == from_status
+
+    def test_members_cannot_change_datasets(self, organization, users, sent):
+        dataset = make_dataset("dataset", organization, workflow_status="draft")
+
+        result = _transition(
+            users["member"].name, ids=[dataset.id], workflow_status="draft"
+        )
+
+        assert result["errors"] == {dataset.id: "Not authorized to update this dataset"}
+
+    def test_unknown_datasets_are_reported(self, users, sent):
+        result = _transition(
+            users["admin"].name, ids=["missing"], workflow_status="draft"
+        )
+
+        assert result == {"updated": [], "errors": {"missing": "Dataset not found"}}
+
+    @pytest.mark.parametrize(
+        "role, from_status, to_status, organization_visibility, expected_private",
+        [
+            # DATAVIC-108: only admins release datasets visible to all organisations
+            ("admin", "ready_for_approval", "published", "all", False),
+            ("admin", "ready_for_approval", "published", "current", True),
+            ("editor", "published", "archived", "all", True),
+        ],
+    )
+    def test_privacy(
+        self,
+        organization,
+        users,
+        sent,
+        role,
+        from_status,
+        to_status,
+        organization_visibility,
+        expected_private,
+    ):
+        dataset = make_dataset(
+            "dataset",
+            organization,
+            workflow_status=from_status,
+            organization_visibility=organization_visibility,
+        )
+
+        result = _transition(
+            users[role].name, ids=[dataset.id], workflow_status=to_status, private=False
+        )
+
+        assert result["updated"] == [dataset.id]
+        assert _status(dataset.id) == (to_status, expected_private)
+
+    def test_too_many_ids(self, organization, users, sent, monkeypatch):
+        monkeypatch.setattr(action, "BULK_TRANSITION_LIMIT", 2)
+        ids = [
+            make_dataset(f"dataset-{index}", organization, workflow_status="draft").id
+            for index in range(3)
+        ]
+
+        with pytest.raises(tk.ValidationError):
+            _transition(users["admin"].name, ids=ids, workflow_status="draft")
+
+        # Duplicates are only counted once
+        result = _transition(
+            users["editor"].name,
+            ids=[ids[0], ids[0], ids[1]],
+            workflow_status="ready_for_approval",
+        )
+        assert sorted(result["updated"]) == sorted(ids[:2])
+
+    def test_query_matching_too_many_datasets(
+        self, organization, users, sent, monkeypatch
+    ):
+        for index in range(3):
+            make_dataset(f"dataset-{index}", organization, workflow_status="draft")
+        search.rebuild()
+        monkeypatch.setattr(action, "BULK_TRANSITION_LIMIT", 2)
+
+        with pytest.raises(tk.ValidationError) as error:
+            _transition(users["admin"].name, q="name:dataset*", workflow_status="draft")
+        assert "q" in error.value.error_dict
+
+    def test_without_user(self, organization, sent):
+        dataset = make_dataset("dataset", organization, workflow_status="draft")
+
+        with pytest.raises(tk.NotAuthorized):
+            _transition("", ids=[dataset.id], workflow_status="ready_for_approval")
+
+    def test_one_email_per_recipient(self, organization, users, sent):
+        ids = [
+            make_dataset(f"dataset-{index}", organization, workflow_status="draft").id
+            for index in range(3)
+        ]
+
+        _transition(users["editor"].name, ids=ids, workflow_status="ready_for_approval")
+
+        assert [notification.recipient_email for notification in sent] == [
+            users["admin"].email
+        ]
+        assert sent[0].subject == "Workflow status changes (3)"
+
+    @pytest.mark.ckan_config("ckan.workflow.notification_digest_interval", "3600")
+    def test_digest_rows_are_committed(self, organization, users, sent):
+        ids = [
+            make_dataset(f"dataset-{index}", organization, workflow_status="draft").id
+            for index in range(2)
+        ]
+
+        _transition(users["editor"].name, ids=ids, workflow_status="ready_for_approval")
+        model.Session.remove()
+
+        queued = model.Session.query(WorkflowNotification).all()
+        assert sorted(item.package_name for item in queued) == ["dataset-0", "dataset-1"]
+        assert {item.recipient_email for item in queued} == {users["admin"].email}
+        assert sent == []
@@ -0,0 +1,74 @@
+from types import SimpleNamespace
+
+import pytest
+
+from ckanext.workflow import helpers, hierarchy
+from ckanext.workflow.tests.benchmarks.synthetic import make_hierarchy
+
+
+@pytest.fixture
+def tree(monkeypatch):
+    # org, org-0 ... org-2, org-0-0 ... org-2-2, org-0-0-0 ... org-2-2-2
+    index, tree = make_hierarchy(depth=3, breadth=3)
+    monkeypatch.setattr(hierarchy, "get_hierarchy", lambda: index)
+    return tree
+
+
+@pytest.mark.parametrize(
+    "organization, user_organizations, relationship, expected",
+    [
+        ("org-0-0-0", ["org-0-0"], "parent", True),
+        ("org-0-0-0", ["org-0"], "parent", False),
+        ("org-0-0-0", ["org-0-1"], "parent", False),
+        ("org-0", ["org-0-1"], "child", True),
+        ("org-0", ["org-0-1-0"], "child", False),
+        ("org-0-0-0", ["org-0-0"], "child", False),
+        ("org-0-0-0", ["org-2-2-2"], "family", True),
+        ("org-0-0-0", ["unrelated"], "family", False),
+        ("org-0-0-0", [], "parent", False),
+    ],
+)
+def test_has_relationship(tree, organization, user_organizations, relationship, expected):
+    assert (
+        helpers.has_relationship(
+            organization, frozenset(user_organizations), relationship
+        )
+        is expected
+    )
+
+
+def test_has_relationship_of_objects(tree):
+    organization = SimpleNamespace(id="org-0-0-0")
+    user_organizations = [SimpleNamespace(id="org-0-0")]
+
+    assert helpers.has_relationship(organization, user_organizations, "parent")
+
+
+def test_find_match_in_list(tree):
+    leaves = tree.levels[-1]
+
+    assert helpers.find_match_in_list(leaves, frozenset(["unrelated", "org-1-2-0"]))
+    assert helpers.find_match_in_list(
+        [SimpleNamespace(id=leaf) for leaf in leaves], ["org-2-2-2"]
+    )
+    assert not helpers.find_match_in_list(leaves, frozenset(tree.levels[1]))
+    assert not helpers.find_match_in_list([], leaves)
+
+
+@pytest.mark.parametrize(
+    "organization, user_organizations, expected",
+    [
+        ("org-0-0", ["org-0-0-1"], ["all", "child", "family"]),
+        ("org-0-0-1", ["org-0-0"], ["all", "parent", "family"]),
+        ("org-0-0-1", ["org-2-2"], ["all", "family"]),
+        ("org-0-0-1", ["unrelated"], ["all"]),
+    ],
+)
+def test_organization_relationships_for_user(
+    tree, organization, user_organizations, expected
+):
+    relationships = helpers.get_organization_relationships_for_user(
+        organization, user_organizations
+    )
+
+    assert list(relationships) == expected
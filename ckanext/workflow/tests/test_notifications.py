@@ -0,0 +1,101 @@
+import smtplib
+
+import pytest
+
+from ckanext.workflow import notifications
+
+
+class FakeSMTP:
+    instances = []
+
+    def __init__(self, host):
+        self.host = host
+        self.calls = []
+        self.sent = []
+        FakeSMTP.instances.append(self)
+
+    def ehlo(self):
+        self.calls.append("ehlo")
+
+    def has_extn(self, name):
+        return name == "STARTTLS"
+
+    def starttls(self):
+        self.calls.append("starttls")
+
+    def login(self, user, password):
+        self.calls.append(("login", user, password))
+
+    def sendmail(self, mail_from, recipients, message):
+        if recipients == ["bounce@example.com"]:
+            raise smtplib.SMTPRecipientsRefused({})
+        self.sent.append((mail_from, recipients))
+
+    def quit(self):
+        self.calls.append("quit")
+
+
+@pytest.fixture
+def smtp(monkeypatch):
+    FakeSMTP.instances = []
+    monkeypatch.setattr(notifications.smtplib, "SMTP", FakeSMTP)
+    return FakeSMTP
+
+
+@pytest.mark.ckan_config("smtp.server", "mail.example.com:587")
+@pytest.mark.ckan_config("smtp.starttls", "true")
+@pytest.mark.ckan_config("smtp.user", "ckan")
+@pytest.mark.ckan_config("smtp.password", "secret")
+@pytest.mark.ckan_config("smtp.mail_from", "ckan@example.com")
+def test_batch_is_sent_over_one_session(smtp):
+    failed = notifications.send_notifications(
+        [
+            notifications.Notification("admin1@example.com", "Subject", "Body"),
+            notifications.Notification("", "Subject", "Body"),
+            notifications.Notification("bounce@example.com", "Subject", "Body"),
+            notifications.Notification("admin2@example.com", "Subject", "Body"),
+        ]
+    )
+
+    (connection,) = smtp.instances
+    assert connection.host == "mail.example.com:587"
+    assert connection.calls == [
+        "ehlo",
+        "starttls",
+        "ehlo",
+        ("login", "ckan", "secret"),
+        "quit",
+    ]
+    assert connection.sent == [
+        ("ckan@example.com", ["admin1@example.com"]),
+        ("ckan@example.com", ["admin2@example.com"]),
+    ]
+    assert [n.recipient_email for n in failed] == ["bounce@example.com"]
+
+
+def test_nothing_to_send_opens_no_session(smtp):
+    assert notifications.send_notifications([]) == []
+    assert smtp.instances == []
+
+
+@pytest.mark.ckan_config("ckan.workflow.notifications_async", "true")
+def test_dispatch_falls_back_to_a_thread(smtp, monkeypatch):
+    sent = []
+
+    def enqueue_job(*args, **kwargs):
+        raise RuntimeError("no job queue")
+
+    class Thread:
+        def __init__(self, target, args, daemon):
+            self.target, self.args = target, args
+
+        def start(self):
+            sent.extend(self.args[0])
+
+    monkeypatch.setattr(notifications.tk, "enqueue_job", enqueue_job)
+    monkeypatch.setattr(notifications.threading, "Thread", Thread)
+    notification = notifications.Notification("admin@example.com", "Subject", "Body")
+
+    notifications.dispatch([notification])
+
+    assert sent == [notification]
@@ -0,0 +1,195 @@
+"""The organisation rules of the dataset search filter, and the indexed
+visibility tokens, against the original per-organisation expansion."""
+import itertools
+import re
+from types import SimpleNamespace
+
+import pytest
+
+from ckanext.workflow import helpers
+from ckanext.workflow.logic import queries, visibility
+from ckanext.workflow.tests.benchmarks.synthetic import make_hierarchy
+
+VISIBILITIES = ["all", "current", "parent", "child", "family"]
+STATUSES = ["published", "draft"]
+
+# org, org-0 and org-1, org-0-0 ... org-1-1, org-0-0-0 ... org-1-1-1
+INDEX, TREE = make_hierarchy(depth=3, breadth=2)
+ORGANIZATION_IDS = sorted(itertools.chain.from_iterable(TREE.levels))
+
+USERS = {
+    "admin": ({"org-0-0": "admin"}, False),
+    "editor": ({"org-0-0": "editor"}, False),
+    "member": ({"org-1-0-1": "member"}, False),
+    "top_level_editor": ({"org": "editor"}, False),
+    "mixed": ({"org-0": "editor", "org-0-1": "admin", "org-1-1-0": "member"}, False),
+    "sysadmin_editor": ({"org-0-0": "editor"}, True),
+}
+
+
+def _user(name):
+    memberships, sysadmin = USERS[name]
+    user = SimpleNamespace(id=name, sysadmin=sysadmin)
+    roles = helpers.UserRoles(
+        (organization_id, organization_id, "active", capacity)
+        for organization_id, capacity in memberships.items()
+    )
+    return user, roles
+
+
+def _old_organization_rules(user, roles, organizations):
+    # The per-organisation expansion _organization_rules replaced
+    rules = []
+    for organization_id in sorted(roles.organization_ids):
+        role = roles.get(organization_id)
+        if role == "admin":
+            rules.append(f'(owner_org:"{organization_id}")')
+        else:
+            rules.append(
+                f'(owner_org:"{organization_id}" AND workflow_status:"published")'
+            )
+        if role in ["admin", "editor", "member"]:
+            if role == "admin" or user.sysadmin:
+                query = '(owner_org:"{0}" AND organization_visibility:"{1}")'
+            else:
+                query = '(owner_org:"{0}" AND organization_visibility:"{1}" AND workflow_status:"published")'
+            for child_id in sorted(organizations.children(organization_id)):
+                rules.append(query.format(child_id, "parent"))
+            for parent_id in sorted(organizations.parents(organization_id)):
+                rules.append(query.format(parent_id, "child"))
+            for ancestor_id in sorted(organizations.ancestors(organization_id)):
+                rules.append(query.format(ancestor_id, "family"))
+                for descendant_id in sorted(organizations.descendants(ancestor_id)):
+                    rules.append(query.format(descendant_id, "family"))
+            for descendant_id in sorted(organizations.descendants(organization_id)):
+                rules.append(query.format(descendant_id, "family"))
+    return tuple(rules)
+
+
+def _parse(rule):
+    """(owner organisation ids, organization_visibility, published only) of a rule."""
+    match = re.fullmatch(r"(?:filter\((.*)\)|\((.*)\))", rule)
+    terms = (match.group(1) or match.group(2)).split(" AND ")
+    owner_orgs, organization_visibility, published_only = frozenset(), None, False
+    for term in terms:
+        field, _, value = term.partition(":")
+        if field == "owner_org":
+            owner_orgs = frozenset(re.findall(r'"([^"]*)"', value))
+        elif field == "organization_visibility":
+            organization_visibility = value.strip('"')
+        elif field == "workflow_status":
+            assert value == '"published"'
+            published_only = True
+        else:
+            raise AssertionError(f"Unexpected term {term}")
+    return owner_orgs, organization_visibility, published_only
+
+
+def _matches(rule, dataset):
+    owner_orgs, organization_visibility, published_only = _parse(rule)
+    owner_org, dataset_visibility, workflow_status = dataset
+    return (
+        owner_org in owner_orgs
+        and organization_visibility in (None, dataset_visibility)
+        and (not published_only or workflow_status == "published")
+    )
+
+
+def _datasets():
+    return itertools.product(ORGANIZATION_IDS, VISIBILITIES, STATUSES)
+
+
+def _visible(rules):
+    return {
+        dataset
+        for dataset in _datasets()
+        if any(_matches(rule, dataset) for rule in rules)
+    }
+
+
+@pytest.mark.parametrize("name", USERS)
+def test_rules_match_the_old_expansion(name):
+    user, roles = _user(name)
+
+    rules = queries._organization_rules(user, roles, INDEX)
+
+    assert _visible(rules) == _visible(_old_organization_rules(user, roles, INDEX))
+    # Each kind of rule is emitted once, and each organisation once per kind
+    kinds = [_parse(rule)[1:] for rule in rules]
+    assert len(kinds) == len(set(kinds))
+
+
+@pytest.mark.parametrize(
+    "name, expected",
+    [
+        (
+            "admin",
+            {
+                (None, False): {"org-0-0"},
+                ("parent", False): {"org-0-0-0", "org-0-0-1"},
+                ("child", False): {"org-0"},
+                # The root is an ancestor, so the whole tree is family
+                ("family", False): set(ORGANIZATION_IDS) - {"org-0-0"},
+            },
+        ),
+        (
+            "editor",
+            {
+                (None, True): {"org-0-0"},
+                ("parent", True): {"org-0-0-0", "org-0-0-1"},
+                ("child", True): {"org-0"},
+                ("family", True): set(ORGANIZATION_IDS) - {"org-0-0"},
+            },
+        ),
+        (
+            "top_level_editor",
+            {
+                (None, True): {"org"},
+                ("parent", True): {"org-0", "org-1"},
+                # Descendants only, the root has no ancestors
+                ("family", True): set(ORGANIZATION_IDS) - {"org"},
+            },
+        ),
+        (
+            "sysadmin_editor",
+            {
+                (None, True): {"org-0-0"},
+                ("parent", False): {"org-0-0-0", "org-0-0-1"},
+                ("child", False): {"org-0"},
+                ("family", False): set(ORGANIZATION_IDS),
+            },
+        ),
+    ],
+)
+def test_organizations_covered_by_each_rule(name, expected):
+    user, roles = _user(name)
+
+    covered = {}
+    for rule in queries._organization_rules(user, roles, INDEX):
+        owner_orgs, organization_visibility, published_only = _parse(rule)
+        covered[(organization_visibility, published_only)] = set(owner_orgs)
+
+    assert covered == expected
+
+
+@pytest.mark.parametrize("name", USERS)
+def test_indexed_tokens_match_the_rules(name):
+    user, roles = _user(name)
+    user_tokens = set(visibility.user_tokens(user, roles))
+
+    by_tokens = {
+        dataset
+        for dataset in _datasets()
+        if not user_tokens.isdisjoint(
+            visibility.dataset_tokens(
+                {
+                    "owner_org": dataset[0],
+                    "organization_visibility": dataset[1],
+                    "workflow_status": dataset[2],
+                },
+                INDEX,
+            )
+        )
+    }
+
+    assert by_tokens == _visible(queries._organization_rules(user, roles, INDEX))
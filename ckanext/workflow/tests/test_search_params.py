@@ -0,0 +1,36 @@
+import pytest
+
+from ckanext.workflow.search_params import owner_orgs
+
+
+@pytest.mark.parametrize(
+    "fq, expected",
+    [
+        ('owner_org:"1a2b"', ("1a2b",)),
+        (' owner_org:"1a2b" +dataset_type:dataset', ("1a2b",)),
+        ("owner_org:1a2b", ("1a2b",)),
+        ('+owner_org:"1a2b" capacity:public', ("1a2b",)),
+        ('owner_org:("1a2b" OR "3c4d")', ("1a2b", "3c4d")),
+        ("owner_org:(1a2b OR +3c4d)", ("1a2b", "3c4d")),
+        ('(owner_org:"1a2b") AND tags:"water quality"', ("1a2b",)),
+        ('owner_org:"1a2b" OR owner_org:"3c4d"', ("1a2b", "3c4d")),
+        ('owner_org:"1a2b" owner_org:"1a2b"', ("1a2b",)),
+        ('-owner_org:"1a2b" owner_org:"3c4d"', ("3c4d",)),
+        ('res_owner_org:"1a2b"', ()),
+        ("owner_org:*", ()),
+        ('owner_org:"1a2b', ()),
+        ("tags:water", ()),
+        ("", ()),
+        (None, ()),
+    ],
+)
+def test_owner_orgs(fq, expected):
+    assert owner_orgs(fq) == expected
+
+
+def test_owner_orgs_of_several_params():
+    assert owner_orgs('owner_org:"1a2b"', 'owner_org:"3c4d" water') == (
+        "1a2b",
+        "3c4d",
+    )
+    assert owner_orgs(None, 'owner_org:"3c4d"') == ("3c4d",)
@@ -0,0 +1,179 @@
+import copy
+import json
+import os
+
+import pytest
+
+from ckan.exceptions import CkanConfigurationException
+
+from ckanext.workflow import settings
+
+EXAMPLE_PATH = os.path.join(
+    os.path.dirname(settings.__file__), "example.settings.json"
+)
+
+
+@pytest.fixture
+def example():
+    with open(EXAMPLE_PATH) as json_data:
+        return json.load(json_data)
+
+
+def _old_editor_rules(current_workflow_status, workflow_status):
+    # The chain WorkflowSettings replaced
+    if current_workflow_status == "published" and workflow_status != "archived":
+        workflow_status = "draft"
+    elif current_workflow_status == "draft" and workflow_status != "draft":
+        workflow_status = "ready_for_approval"
+    elif (
+        current_workflow_status == "ready_for_approval"
+        and workflow_status != "ready_for_approval"
+    ):
+        workflow_status = "draft"
+    elif current_workflow_status == "archived" and workflow_status != "draft":
+        workflow_status = "draft"
+    return workflow_status
+
+
+def _old_admin_rules(current_workflow_status, workflow_status):
+    # The chain WorkflowSettings replaced
+    if not current_workflow_status == workflow_status:
+        if current_workflow_status == "draft" and workflow_status != "draft":
+            workflow_status = "ready_for_approval"
+        elif (
+            current_workflow_status == "ready_for_approval"
+            and workflow_status != "published"
+        ):
+            workflow_status = "draft"
+        elif current_workflow_status == "published" and workflow_status != "archived":
+            workflow_status = "draft"
+        elif current_workflow_status == "archived" and workflow_status != "draft":
+            workflow_status = "draft"
+    return workflow_status
+
+
+# Editors may keep a dataset archived, as the settings always allowed
+CHANGED = {("editor", "archived", "archived"): ("draft", "archived")}
+
+
+@pytest.mark.parametrize("with_fallbacks", [True, False])
+@pytest.mark.parametrize(
+    "role, old_rules", [("editor", _old_editor_rules), ("admin", _old_admin_rules)]
+)
+def test_transitions_match_the_old_rules(example, with_fallbacks, role, old_rules):
+    if not with_fallbacks:
+        # Settings files written before "fallbacks" existed
+        del example["fallbacks"]
+    workflow_settings = settings.WorkflowSettings(example)
+
+    differences = {}
+    for current in workflow_settings.statuses:
+        for requested in workflow_settings.statuses:
+            old = old_rules(current, requested)
+            new = workflow_settings.resolve_transition(role, current, requested)
+            if old != new:
+                differences[(role, current, requested)] = (old, new)
+
+    assert differences == {
+        key: value for key, value in CHANGED.items() if key[0] == role
+    }
+
+
+def test_other_roles_keep_datasets_in_draft(example):
+    workflow_settings = settings.WorkflowSettings(example)
+
+    for role in ["member", None, "unknown"]:
+        for current in workflow_settings.statuses:
+            for requested in workflow_settings.statuses:
+                assert (
+                    workflow_settings.resolve_transition(role, current, requested)
+                    == "draft"
+                )
+
+
+def test_empty_fallbacks_use_the_default_status(example):
+    example["fallbacks"] = {}
+    workflow_settings = settings.WorkflowSettings(example)
+
+    assert workflow_settings.resolve_transition("admin", "draft", "published") == "draft"
+
+
+def test_unknown_statuses_are_resolved_from_draft(example):
+    workflow_settings = settings.WorkflowSettings(example)
+
+    assert (
+        workflow_settings.resolve_transition("editor", None, "ready_for_approval")
+        == "ready_for_approval"
+    )
+    assert (
+        workflow_settings.resolve_transition("admin", "draft", "unknown")
+        == "ready_for_approval"
+    )
+
+
+@pytest.mark.parametrize(
+    "change, message",
+    [
+        # Nothing moves to "archived"
+        (
+            lambda data: [
+                targets.remove("archived")
+                for targets in data["workflows"].values()
+                if "archived" in targets
+            ],
+            "cannot be reached",
+        ),
+        # Datasets can never leave "archived"
+        (
+            lambda data: data["workflows"].__setitem__("archived", ["archived"]),
+            "no way out",
+        ),
+        (
+            lambda data: data["workflows"]["draft"].append("deleted"),
+            "undefined statuses",
+        ),
+        (
+            lambda data: data["roles"]["editor"].__setitem__(
+                "default_workflow_status", "deleted"
+            ),
+            "undefined statuses",
+        ),
+        (
+            lambda data: data["fallbacks"].__setitem__("draft", "deleted"),
+            "undefined statuses",
+        ),
+        (lambda data: data.pop("roles"), '"roles"'),
+    ],
+)
+def test_invalid_settings_are_rejected(example, change, message):
+    data = copy.deepcopy(example)
+    change(data)
+
+    with pytest.raises(CkanConfigurationException, match=message):
+        settings.WorkflowSettings(data)
+
+
+def test_invalid_reload_keeps_the_last_good_copy(example, tmp_path, monkeypatch):
+    path = tmp_path / "workflow.settings.json"
+    path.write_text(json.dumps(example))
+    monkeypatch.setitem(settings.tk.config, settings.CONFIG_PATH, str(path))
+    cache = settings._SettingsCache()
+
+    loaded = cache.get()
+    assert loaded.data == example
+
+    # Edited in place into an invalid file
+    example["workflows"]["archived"] = ["archived"]
+    path.write_text(json.dumps(example))
+    os.utime(path, ns=(0, 1))
+
+    assert cache.get() is loaded
+
+
+def test_invalid_first_load_fails(example, tmp_path, monkeypatch):
+    path = tmp_path / "workflow.settings.json"
+    path.write_text("{not json")
+    monkeypatch.setitem(settings.tk.config, settings.CONFIG_PATH, str(path))
+
+    with pytest.raises(ValueError):
+        settings._SettingsCache().get()
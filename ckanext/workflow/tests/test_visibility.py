@@ -0,0 +1,76 @@
+import pytest
+
+import ckan.model as model
+from ckan.tests import helpers as test_helpers
+
+from ckanext.workflow import hierarchy
+from ckanext.workflow.logic import visibility
+from ckanext.workflow.tests.benchmarks.synthetic import (
+    make_organization_tree,
+    reset_caches,
+)
+
+
+@pytest.fixture(autouse=True)
+def _reset_workflow_caches():
+    reset_caches()
+    yield
+    reset_caches()
+
+
+@pytest.fixture
+def reindexed(monkeypatch):
+    reindexed = []
+    monkeypatch.setattr(
+        visibility, "enqueue_reindex", lambda ids: reindexed.extend(sorted(ids))
+    )
+    return reindexed
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_index_dataset_ignores_the_cached_hierarchy():
+    # org with children org-0 and org-1
+    tree = make_organization_tree(1, 2)
+    first, second = tree.levels[1]
+    hierarchy.get_hierarchy()
+
+    # Moved by another process, so this process' index does not know yet
+    membership = (
+        model.Session.query(model.Member)
+        .filter_by(table_id=second, table_name="group")
+        .one()
+    )
+    membership.group_id = first
+    model.Session.commit()
+
+    pkg_dict = visibility.index_dataset(
+        {
+            "owner_org": second,
+            "organization_visibility": "parent",
+            "workflow_status": "published",
+        }
+    )
+
+    assert f"related:{first}" in pkg_dict[visibility.FIELD]
+    assert f"related:{tree.root_id}" not in pkg_dict[visibility.FIELD]
+
+
+@pytest.mark.ckan_config("ckan.plugins", "workflow")
+@pytest.mark.ckan_config("ckan.workflow.index_visibility", "true")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+@pytest.mark.parametrize("action", ["organization_delete", "organization_purge"])
+def test_removing_an_organization_reindexes_its_tree(reindexed, action):
+    # org, org-0 and org-1, org-0-0 and org-0-1, ...
+    tree = make_organization_tree(2, 2)
+    removed = tree.levels[1][0]
+    hierarchy.get_hierarchy()
+
+    test_helpers.call_action(action, id=removed)
+
+    assert removed not in reindexed
+    assert set(reindexed) == {
+        organization_id
+        for level in tree.levels
+        for organization_id in level
+        if organization_id != removed
+    }
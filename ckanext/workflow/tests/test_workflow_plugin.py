@@ -0,0 +1,125 @@
+import pytest
+
+import ckan.lib.search as search
+import ckan.model as model
+import ckan.plugins as plugins
+import ckan.plugins.toolkit as toolkit
+from ckan.tests import factories
+
+from ckanext.workflow import helpers
+from ckanext.workflow.logic import queries
+from ckanext.workflow.tests.benchmarks.synthetic import (
+    make_dataset,
+    make_organization_tree,
+    make_user,
+)
+from ckanext.workflow.workflow_plugin import add_filter, add_state_filter
+
+
+def test_filters_are_routed_explicitly():
+    search_params = {"fq": 'tags:"water"'}
+
+    add_filter(search_params, "capacity:public")
+    add_filter(search_params, "  ")
+    add_state_filter(search_params, queries.VISIBLE_STATES)
+
+    assert search_params["fq_list"] == ["capacity:public"]
+    assert search_params["fq"] == 'tags:"water" +state:(draft OR active)'
+
+
+@pytest.mark.ckan_config("ckan.plugins", "workflow")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+def test_dataset_search_rules_are_a_separate_fq(app, monkeypatch):
+    user = model.User.get(factories.User()["id"])
+    monkeypatch.setattr(toolkit, "current_user", user)
+
+    with app.flask_app.test_request_context("/dataset/"):
+        search_params = plugins.get_plugin("workflow").before_dataset_search(
+            {"fq": 'tags:"water"', "extras": {}}
+        )
+
+    assert search_params["fq"] == 'tags:"water" +state:(draft OR active)'
+    (rules,) = search_params["fq_list"]
+    assert rules == queries.package_search_filter_query(user)
+    assert f'creator_user_id:"{user.id}"' in rules
+    assert "+state" not in rules
+
+
+@pytest.mark.ckan_config("ckan.plugins", "workflow")
+@pytest.mark.usefixtures("with_plugins", "clean_db", "clean_index")
+def test_creator_finds_own_draft_in_dataset_search(app):
+    creator = factories.UserWithToken()
+    other_editor = factories.UserWithToken()
+    organization = factories.Organization(
+        users=[
+            {"name": creator["name"], "capacity": "editor"},
+            {"name": other_editor["name"], "capacity": "editor"},
+        ]
+    )
+    dataset = factories.Dataset(
+        owner_org=organization["id"], private=True, user=creator
+    )
+    package = model.Package.get(dataset["id"])
+    package.state = "draft"
+    model.repo.commit()
+    search.rebuild(package.id)
+
+    response = app.get("/dataset/", headers={"Authorization": creator["token"]})
+    assert dataset["name"] in response.body
+
+    # Editors only see the published datasets of their organisation
+    response = app.get("/dataset/", headers={"Authorization": other_editor["token"]})
+    assert dataset["name"] not in response.body
+
+
+@pytest.fixture
+def notified(monkeypatch):
+    notified = []
+    monkeypatch.setattr(
+        helpers, "notify_admin_users", lambda *args: notified.append("admins")
+    )
+    monkeypatch.setattr(helpers, "notify_creator", lambda *args: notified.append("creator"))
+    return notified
+
+
+@pytest.mark.ckan_config("ckan.plugins", "workflow")
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+@pytest.mark.parametrize(
+    "role, from_status, requested, organization_visibility, expected",
+    [
+        ("editor", "draft", "ready_for_approval", "all", ("ready_for_approval", True)),
+        ("editor", "draft", "published", "all", ("ready_for_approval", True)),
+        ("editor", "ready_for_approval", "published", "all", ("draft", True)),
+        ("editor", "published", "published", "all", ("draft", True)),
+        ("editor", "published", "archived", "all", ("archived", True)),
+        ("admin", "ready_for_approval", "published", "all", ("published", False)),
+        ("admin", "ready_for_approval", "published", "current", ("published", True)),
+        ("member", "draft", "ready_for_approval", "all", ("draft", True)),
+    ],
+)
+def test_form_edit_enforces_the_role_transitions(
+    app, notified, role, from_status, requested, organization_visibility, expected
+):
+    organization = make_organization_tree(0, 0).root_id
+    user = make_user("user", {organization: role})
+    package = make_dataset(
+        "dataset",
+        organization,
+        workflow_status=from_status,
+        organization_visibility=organization_visibility,
+    )
+
+    # The dataset form asks for a public release
+    package.extras["workflow_status"] = requested
+    package.private = False
+    with app.flask_app.test_request_context(f"/dataset/edit/{package.name}"):
+        toolkit.g.userobj = user
+        plugins.get_plugin("workflow").edit(package)
+
+    assert (package.extras["workflow_status"], package.private) == expected
+    if (from_status, expected[0]) == ("draft", "ready_for_approval"):
+        assert notified == ["admins"]
+    elif (from_status, expected[0]) == ("ready_for_approval", "draft"):
+        assert notified == ["creator"]
+    else:
+        assert notified == []
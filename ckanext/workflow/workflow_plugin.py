@@ -3,165 +3,257 @@ import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 import logging
 
-from ckanext.workflow.logic import auth, queries
-from ckanext.workflow import helpers
+from flask import has_request_context
+
+from ckanext.workflow.logic import action, auth, queries, visibility
+from ckanext.workflow import (
+    cli,
+    harvest,
+    helpers,
+    instrumentation,
+    settings,
+    subscriptions,
+)
+from ckanext.workflow.search_params import owner_orgs
+from ckanext.workflow.model import previous_workflow_status, record_transition
 
 
 config = toolkit.config
 log = logging.getLogger(__name__)
 
+# Solr filter for each `ext_visibility` search extra, "all" needs none
+CAPACITY_FILTERS = {
+    "private": "capacity:private",
+    "public": "capacity:public",
+}
+# Anonymous users can only ever see public datasets
+ANONYMOUS_CAPACITY_FILTERS = {
+    "all": "capacity:public",
+    "private": "capacity:private",
+    "public": "capacity:public",
+}
+
+
+def add_filter(search_params, clause):
+    """Add a clause as a separate Solr fq, so that Solr caches its matches
+    independently of the other filters of the search."""
+    clause = clause.strip()
+    if clause:
+        search_params["fq_list"] = list(search_params.get("fq_list") or []) + [clause]
+
+
+def add_state_filter(search_params, clause):
+    """Add a filter on the dataset state to ``fq``.
+
+    CKAN only leaves out its default ``+state:active`` filter when ``fq``
+    mentions ``+state``, so state filters cannot go in ``fq_list``.
+    """
+    search_params["fq"] = "{0} {1}".format(search_params.get("fq") or "", clause).strip()
+
 
 class WorkflowPlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IPackageController, inherit=True)
     plugins.implements(plugins.IAuthFunctions)
+    plugins.implements(plugins.IActions)
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IConfigurable)
+    plugins.implements(plugins.ISignal)
+    plugins.implements(plugins.IClick)
+    plugins.implements(plugins.IBlueprint)
 
     # IConfigurer interface #
     def update_config(self, config):
         """Setup the template directory"""
         toolkit.add_template_directory(config, "templates_workflow")
 
+    # IConfigurable
+    def configure(self, config):
+        # Fail on startup rather than on the first dataset form render
+        settings.load_settings()
+        instrumentation.configure()
+
+    # ISignal
+    def get_signal_subscriptions(self):
+        return subscriptions.get_subscriptions()
+
+    # IClick
+    def get_commands(self):
+        return cli.get_commands()
+
+    # IBlueprint
+    def get_blueprint(self):
+        return instrumentation.get_blueprints()
+
     # IAuthFunctions
     def get_auth_functions(self):
         return {
             'organization_create': auth.organization_create,
             'organization_update': auth.organization_update,
             'package_show': auth.package_show,
+            'workflow_transition_list': auth.workflow_transition_list,
+            'workflow_stale_dataset_list': auth.workflow_stale_dataset_list,
+            'workflow_bulk_transition': auth.workflow_bulk_transition,
+            'workflow_filter_visible': auth.workflow_filter_visible,
+            'workflow_organization_autocomplete': auth.workflow_organization_autocomplete,
         }
 
+    # IActions
+    def get_actions(self):
+        return action.get_actions()
+
     # IPackageController
 
+    @instrumentation.timed("WorkflowPlugin.create")
     def create(self, entity):
         # DATAVIC-56: "Each dataset is initially created in a 'Draft' status"
-        if repr(toolkit.request) != "<LocalProxy unbound>" and toolkit.get_endpoint()[
-            0
-        ] in ["package", "dataset", "datavic_dataset"]:
+        if harvest.is_dataset_form_save():
             entity.extras["workflow_status"] = "draft"
+            user_id = toolkit.g.userobj.id if toolkit.g.userobj else None
         # Harvester created datasets
         else:
             self.set_harvested_dataset_workflow_properties(entity)
+            user_id = None
+
+        record_transition(entity, None, entity.extras.get("workflow_status"), user_id)
 
         return entity
 
+    @instrumentation.timed("WorkflowPlugin.edit")
     def edit(self, entity):
 
         # Datasets updated through the UI need to be handled differently that those updated via the Harvester
-        if repr(toolkit.request) != "<LocalProxy unbound>" and toolkit.get_endpoint()[
-            0
-        ] in ["package", "dataset", "datavic_dataset"]:
+        if harvest.is_dataset_form_save():
             user = toolkit.g.userobj
             role = helpers.role_in_org(entity.owner_org, user.name)
+            sysadmin = authz.is_sysadmin(user.name)
 
             workflow_status = entity.extras.get("workflow_status", None)
             organization_visibility = entity.extras.get("organization_visibility", None)
 
+            # The status stored before this update, tracked from the session
+            # rather than loaded from the activity stream
+            previous_status = previous_workflow_status(entity)
+
+            # Only allow the transitions the user's role permits
+            if workflow_status:
+                workflow_status = helpers.resolve_workflow_status(
+                    previous_status, workflow_status, role, sysadmin
+                )
+                if workflow_status != entity.extras.get("workflow_status"):
+                    entity.extras["workflow_status"] = workflow_status
+
             # DATAVIC-108: A dataset can only be set for Public Release (`private` = False)
             # if workflow status and
             # organization visibility are published and all, respectively
             if workflow_status == "published" and organization_visibility == "all":
                 # Super Admins can publish datasets
                 # The only other user that can publish datasets are admins of the organization
-                if not authz.is_sysadmin(user.name) and not role == "admin":
+                if not sysadmin and not role == "admin":
                     entity.private = True
             else:
                 # Dataset is Private until workflow_status becomes "published"
                 entity.private = True
 
-            # BEGIN: DATAVIC-251 CKAN 2.9 upgrade
-            # BEGIN: DATAVIC-251 CKAN 2.9 upgrade
-            from pprint import pprint
-
-            activity_diffs = helpers.get_activity_diffs(entity.id)
-            # Check if there are recorded activities
-            if activity_diffs:
-                # pprint(activity_diffs.get('activities')[0])
-                previous_workflow_status = (
-                    activity_diffs.get("data").get("package").get("workflow_status")
+            if workflow_status != previous_status:
+                record_transition(
+                    entity,
+                    previous_status,
+                    workflow_status,
+                    user.id,
+                    entity.extras.get("workflow_status_notes"),
                 )
 
-                if workflow_status != previous_workflow_status:
-                    # If workflow_status changes from draft to ready_for_approval..
-                    if (
-                        previous_workflow_status == "draft"
-                        and workflow_status == "ready_for_approval"
-                    ):
-                        helpers.notify_admin_users(
-                            entity.owner_org, user.name, entity.name
-                        )
-                    # Else, if workflow_status changes from ready_for_approval back to draft..
-                    elif (
-                        previous_workflow_status == "ready_for_approval"
-                        and workflow_status == "draft"
-                    ):
-                        workflow_status_notes = entity.extras.get(
-                            "workflow_status_notes"
-                        )
-
-                        helpers.notify_creator(
-                            entity.name, entity.creator_user_id, workflow_status_notes
-                        )
+                # If workflow_status changes from draft to ready_for_approval..
+                if (
+                    previous_status == "draft"
+                    and workflow_status == "ready_for_approval"
+                ):
+                    helpers.notify_admin_users(
+                        entity.owner_org, user.name, entity.name
+                    )
+                # Else, if workflow_status changes from ready_for_approval back to draft..
+                elif (
+                    previous_status == "ready_for_approval"
+                    and workflow_status == "draft"
+                ):
+                    workflow_status_notes = entity.extras.get(
+                        "workflow_status_notes"
+                    )
+
+                    helpers.notify_creator(
+                        entity.name, entity.creator_user_id, workflow_status_notes
+                    )
         # Handle datasets updated through the Harvester differently
         else:
+            previous_status = previous_workflow_status(entity)
             self.set_harvested_dataset_workflow_properties(entity)
 
+            workflow_status = entity.extras.get("workflow_status")
+            if workflow_status != previous_status:
+                record_transition(entity, previous_status, workflow_status)
+
         return entity
 
+    @instrumentation.timed("WorkflowPlugin.before_dataset_search")
     def before_dataset_search(self, search_params):
         search_params["include_private"] = True
 
-        if not search_params.get("fq"):
-            search_params["fq"] = ""
-
-        ext_visibility = search_params["extras"].get("ext_visibility", "all")
-
-        visibility_mapping = {"all": "*", "private": "private", "public": "public"}
-
-        search_params["fq"] += f" capacity:{visibility_mapping[ext_visibility]} "
-
-        controller_action = (
-            "{0}.{1}".format(*toolkit.get_endpoint())
-            if toolkit.request
-            else "api.action"
+        ext_visibility = (search_params.get("extras") or {}).get(
+            "ext_visibility", "all"
         )
-        fq = search_params["fq"]
 
-        if controller_action == "organization.read":
-            organization_id = None
+        # Searches from background jobs and commands are only filtered by
+        # the visibility asked for
+        if not has_request_context():
+            add_filter(search_params, CAPACITY_FILTERS.get(ext_visibility, ""))
+            return search_params
+
+        user = toolkit.current_user
+        if user.is_anonymous:
+            add_filter(
+                search_params,
+                ANONYMOUS_CAPACITY_FILTERS.get(
+                    ext_visibility, ANONYMOUS_CAPACITY_FILTERS["all"]
+                ),
+            )
+            return search_params
+
+        add_filter(search_params, CAPACITY_FILTERS.get(ext_visibility, ""))
+        # Sysadmins can see every dataset, no visibility rules are needed
+        if user.sysadmin:
+            return search_params
+
+        controller_action = "{0}.{1}".format(*toolkit.get_endpoint())
 
-            if "owner_org:" in fq:
-                organization_id = helpers.get_organization_id({}, fq)
-            elif "owner_org" in search_params.get("q", ""):
-                organization_id = helpers.get_organization_id(
-                    {}, search_params.get("q", "")
+        if controller_action == "organization.read":
+            rules = [
+                queries.organization_read_filter_query(organization_id, user)
+                for organization_id in owner_orgs(
+                    search_params.get("fq"), search_params.get("q")
                 )
-
-            if organization_id:
-                org_fq = queries.organization_read_filter_query(
-                    organization_id, toolkit.current_user.name
+            ]
+            if rules:
+                add_filter(
+                    search_params,
+                    rules[0] if len(rules) == 1 else queries.any_of(rules),
                 )
-                fq += org_fq
 
         elif controller_action == "dataset.search":
-            fq += queries.package_search_filter_query(toolkit.current_user)
-
-        search_params["fq"] = fq
+            # Users see the drafts they created, which the rules allow
+            add_state_filter(search_params, queries.VISIBLE_STATES)
+            add_filter(search_params, queries.package_search_filter_query(user))
 
         return search_params
 
     before_search = before_dataset_search
 
-    def set_harvested_dataset_workflow_properties(self, entity):
-        workflow_status = entity.extras.get("workflow_status", None)
-        organization_visibility = entity.extras.get("organization_visibility", None)
+    def before_dataset_index(self, pkg_dict):
+        if visibility.is_enabled():
+            pkg_dict = visibility.index_dataset(pkg_dict)
 
-        if not workflow_status:
-            if toolkit.asbool(entity.private) is True:
-                entity.extras["workflow_status"] = "draft"
-            else:
-                entity.extras["workflow_status"] = "published"
+        return pkg_dict
 
-        if not organization_visibility:
-            if toolkit.asbool(entity.private) is True:
-                entity.extras["organization_visibility"] = "current"
-            else:
-                entity.extras["organization_visibility"] = "all"
+    before_index = before_dataset_index
+
+    def set_harvested_dataset_workflow_properties(self, entity):
+        harvest.apply_defaults(entity.extras, entity.private)